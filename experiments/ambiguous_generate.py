@@ -39,6 +39,7 @@ from transformers import GenerationConfig
 from llm.datasets.llm_utils_oe import grade_oe_preds #prepare_uncertainty_query
 from llm.logging import entrypoint_with_accelerator
 from llm.models import get_model
+from llm.models.llm_model_utils import get_attn_implementation
 from llm.models.peft import get_lora_model
 from llm.utils.generate_utils import generate_output
 
@@ -274,7 +275,12 @@ def main(model_name=None, max_new_tokens=100, output_path='/workspace/output_amb
         with open('SelfAware.json') as f:
             self_aware = json.load(f)
 
-            tokenizer, model = get_model(model_name, device_map="cuda")
+            tokenizer, model = get_model(
+                model_name,
+                device_map="cuda",
+                attn_implementation=get_attn_implementation(),
+                use_cache=True,
+            )
 
             if adapter_name == 'query':
                 model = PeftModel.from_pretrained(
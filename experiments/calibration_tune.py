@@ -1,8 +1,11 @@
+import os
+
 from llm.datasets import get_dataset, LMText, LabeledStringDataCollator
 from llm.distributed import AcceleratorState
 from llm.logging import entrypoint
 from llm.models import get_model
 from llm.models.peft import get_lora_model, get_temperature_head
+from llm.precision import configure_precision
 from llm.trainer import WandbConfigUpdateCallback, CalibrationTuner
 
 
@@ -14,7 +17,7 @@ def main(
     data_dir=None,
     prompt_style=None,
     max_token_length=None,
-    num_workers=4,
+    num_workers=min(16, os.cpu_count()),
     use_dataset_cache=True,
     model_name=None,
     int8=True,
@@ -28,8 +31,11 @@ def main(
     lr=1e-4,
     warmup_ratio=0.0,
     kl_decay=0.0,
+    kl_topk=0,
     max_steps=1,
 ):
+    configure_precision()
+
     accelerator = AcceleratorState()
 
     trainer_args = CalibrationTuner.Args(
@@ -46,6 +52,7 @@ def main(
         warmup_ratio=warmup_ratio,
         scale_temp=scale_temp,
         kl_decay=kl_decay,
+        kl_topk=kl_topk,
     )
 
     with accelerator.main_process_first():
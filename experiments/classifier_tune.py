@@ -1,3 +1,4 @@
+import os
 import torch
 
 from llm.datasets import get_dataset
@@ -5,6 +6,7 @@ from llm.distributed import AcceleratorState
 from llm.logging import entrypoint
 from llm.models import get_model
 from llm.models.peft import get_lora_model, get_classifier_head, get_temperature_head
+from llm.precision import configure_precision
 from llm.trainer import WandbConfigUpdateCallback, ClassificationTuner
 
 
@@ -16,7 +18,7 @@ def main(
     data_dir=None,
     prompt_style=None,
     max_token_length=None,
-    num_workers=4,
+    num_workers=min(16, os.cpu_count()),
     use_dataset_cache=True,
     model_name=None,
     int8=True,
@@ -31,6 +33,8 @@ def main(
     lr=1e-4,
     max_steps=1,
 ):
+    configure_precision()
+
     accelerator = AcceleratorState()
 
     trainer_args = ClassificationTuner.Args(
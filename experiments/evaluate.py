@@ -2,13 +2,13 @@ import os
 import logging
 from tqdm.auto import tqdm
 import wandb
-import pandas as pd
 import torch
 
 from llm.datasets import get_dataset_attrs, get_dataset
 from llm.eval import evaluate_dataset
 from llm.logging import entrypoint
 from llm.models import get_model
+from llm.models.llm_model_utils import compile_forward, get_attn_implementation
 from llm.models.peft import (
     get_lora_model,
     get_classifier_head,
@@ -16,6 +16,7 @@ from llm.models.peft import (
     get_temperature_scale_model,
 )
 from llm.models.peft.utils import get_last_checkpoint_path
+from llm.precision import configure_precision
 from llm.trainer import ClassificationTuner, CalibrationTuner, FineTuner
 
 
@@ -37,7 +38,10 @@ def main(
     with_classifier=False,
     mode=None,
     batch_size=1,
+    compile_model=False,
 ):
+    configure_precision()
+
     config = dict(
         seed=seed,
         log_dir=log_dir,
@@ -52,25 +56,34 @@ def main(
         with_classifier=with_classifier,
         mode=mode,
         batch_size=batch_size,
+        compile_model=compile_model,
     )
     if accelerator.is_main_process:
         wandb.config.update(config)
 
-    tokenizer, model = get_model(model_name, device_map="auto")
-
-    model = get_lora_model(
-        model,
-        peft_id_or_dir=peft_dir,
-        is_trainable=False,
-        adapter_name="default",
+    tokenizer, model = get_model(
+        model_name,
+        device_map="auto",
+        attn_implementation=get_attn_implementation(),
+        use_cache=True,
     )
 
-    model = get_lora_model(
-        model,
-        peft_id_or_dir=query_peft_dir,
-        is_trainable=False,
-        adapter_name="query",
-    )
+    ## NOTE: Fresh adapters are identity, only attach checkpoints.
+    if peft_dir is not None:
+        model = get_lora_model(
+            model,
+            peft_id_or_dir=peft_dir,
+            is_trainable=False,
+            adapter_name="default",
+        )
+
+    if query_peft_dir is not None:
+        model = get_lora_model(
+            model,
+            peft_id_or_dir=query_peft_dir,
+            is_trainable=False,
+            adapter_name="query",
+        )
 
     if with_classifier:
         if embedding_model_name is not None:
@@ -160,6 +173,9 @@ def main(
 
     model.eval()
 
+    if compile_model:
+        model = compile_forward(model)
+
     if get_dataset_attrs(dataset).get("collection", False):
         all_datasets = get_dataset(dataset)
     else:
@@ -167,7 +183,7 @@ def main(
         all_datasets = [dataset]
 
     all_metrics = []
-    for dataset in tqdm(all_datasets):
+    for dataset in tqdm(all_datasets, disable=not accelerator.is_main_process):
         metrics = evaluate_dataset(
             accelerator,
             model,
@@ -182,16 +198,27 @@ def main(
             batch_size=batch_size,
             log_dir=log_dir,
             evaluate_fn=mode,
+            sort_by_length=compile_model or batch_size > 1,
         )
 
         all_metrics += metrics
+        logging.info({"dataset_done": dataset}, extra=dict(metrics=True))
+
+        accelerator.free_memory()
+
+    if all_metrics and wandb.run is not None:
+        ## NOTE: Metrics may differ across datasets, take the union of keys.
+        columns = list(dict.fromkeys(k for m in all_metrics for k in m.keys()))
         logging.info(
-            {"metrics": wandb.Table(dataframe=pd.DataFrame(all_metrics))},
+            {
+                "metrics": wandb.Table(
+                    columns=columns,
+                    data=[[m.get(c) for c in columns] for m in all_metrics],
+                )
+            },
             extra=dict(metrics=True),
         )
 
-        accelerator.free_memory()
-
     accelerator.wait_for_everyone()
     if accelerator.is_main_process:
         wandb.save(f"{log_dir}/metrics/*", base_path=log_dir)
@@ -1,7 +1,6 @@
 import logging
 from tqdm.auto import tqdm
 import wandb
-import pandas as pd
 
 from llm.datasets import get_dataset_attrs, get_dataset
 from llm.eval import evaluate_dataset
@@ -45,7 +44,7 @@ def main(
         all_datasets = [dataset]
 
     all_metrics = []
-    for dataset in tqdm(all_datasets):
+    for dataset in tqdm(all_datasets, disable=not accelerator.is_main_process):
         metrics = evaluate_dataset(
             accelerator,
             None,
@@ -63,13 +62,23 @@ def main(
         )
 
         all_metrics += metrics
+        logging.info({"dataset_done": dataset}, extra=dict(metrics=True))
+
+        accelerator.free_memory()
+
+    if all_metrics and wandb.run is not None:
+        ## NOTE: Metrics may differ across datasets, take the union of keys.
+        columns = list(dict.fromkeys(k for m in all_metrics for k in m.keys()))
         logging.info(
-            {"metrics": wandb.Table(dataframe=pd.DataFrame(all_metrics))},
+            {
+                "metrics": wandb.Table(
+                    columns=columns,
+                    data=[[m.get(c) for c in columns] for m in all_metrics],
+                )
+            },
             extra=dict(metrics=True),
         )
 
-        accelerator.free_memory()
-
 
 if __name__ == "__main__":
     import fire
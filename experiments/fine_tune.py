@@ -1,8 +1,11 @@
-from llm.datasets import get_dataset
+import os
+
+from llm.datasets import get_dataset, tokenize_dataset
 from llm.distributed import AcceleratorState
 from llm.logging import entrypoint
 from llm.models import get_model
 from llm.models.peft import get_lora_model, get_temperature_scale_model
+from llm.precision import configure_precision
 from llm.trainer import WandbConfigUpdateCallback, FineTuner
 
 
@@ -14,10 +17,11 @@ def main(
     data_dir=None,
     prompt_style=None,
     max_token_length=None,
-    num_workers=4,
+    num_workers=min(16, os.cpu_count()),
     use_dataset_cache=True,
     model_name=None,
     int8=True,
+    int4=False,
     lora_rank=8,
     lora_alpha=32,
     lora_dropout=0.1,
@@ -28,6 +32,8 @@ def main(
     warmup_ratio=0.0,
     max_steps=1,
 ):
+    configure_precision()
+
     accelerator = AcceleratorState()
 
     trainer_args = FineTuner.Args(
@@ -62,8 +68,19 @@ def main(
         model_name,
         device_map={"": accelerator.local_process_index},
         use_int8=int8,
+        use_int4=int4,
     )
 
+    with accelerator.main_process_first():
+        train_data, val_data = [
+            (
+                tokenize_dataset(data, tokenizer, num_workers=num_workers)
+                if data is not None
+                else None
+            )
+            for data in (train_data, val_data)
+        ]
+
     model = get_lora_model(
         model,
         peft_id_or_dir=peft_dir,
@@ -2,7 +2,6 @@ import logging
 from pathlib import Path
 import os
 import wandb
-import pandas as pd
 from tqdm.auto import tqdm
 import numpy as np
 import torch
@@ -16,8 +15,22 @@ from llm.datasets import (
     LMText,
 )
 from llm.logging import entrypoint
-from llm.models import get_model
-from llm.utils.generate_utils import generate_output
+from llm.models import get_model, get_tokenizer
+from llm.models.llm_model_utils import (
+    compile_forward,
+    get_attn_implementation,
+    quantize_int8_weight_only,
+)
+from llm.precision import configure_precision
+from llm.utils.generate_utils import (
+    GenerationCollator,
+    generate_output,
+    generate_output_vllm,
+    get_vllm_model,
+    sort_by_prompt_length,
+    tokenize_prompts,
+    write_csv_rows,
+)
 
 
 @entrypoint(with_accelerator=True)
@@ -30,10 +43,16 @@ def generate_outputs_main(
     prompt_style=None,
     kshot=0,
     use_dataset_cache=True,
-    batch_size=1,
+    batch_size=8,
+    num_workers=min(16, os.cpu_count()),
     model_name=None,
     max_new_tokens=30,
+    backend="hf",
+    compile_model=False,
+    int8_weight_only=False,
 ):
+    configure_precision()
+
     config = {
         "seed": seed,
         "log_dir": log_dir,
@@ -43,6 +62,9 @@ def generate_outputs_main(
         "batch_size": batch_size,
         "model_name": model_name,
         "max_new_tokens": max_new_tokens,
+        "backend": backend,
+        "compile_model": compile_model,
+        "int8_weight_only": int8_weight_only,
     }
     if accelerator.is_main_process:
         wandb.config.update(config)
@@ -55,7 +77,7 @@ def generate_outputs_main(
             dataset,
             root=data_dir,
             seed=seed,
-            num_workers=8,
+            num_workers=num_workers,
             use_cache=use_dataset_cache,
             prompt_style=prompt_style,
             train_kshot=kshot,
@@ -67,33 +89,78 @@ def generate_outputs_main(
             if ds is not None
         ]
 
-    tokenizer, model = get_model(model_name, device_map="auto")
-    model.eval()
+    if backend == "hf":
+        tokenizer, model = get_model(
+            model_name,
+            device_map="auto",
+            attn_implementation=get_attn_implementation(),
+            use_cache=True,
+        )
+        model.eval()
+
+        if int8_weight_only:
+            model = quantize_int8_weight_only(model)
+
+        if compile_model:
+            model = compile_forward(model)
+
+        generate_fn = generate_output
+    elif backend == "vllm":
+        if compile_model or int8_weight_only:
+            logging.warning(
+                "compile_model and int8_weight_only are ignored by the vllm backend."
+            )
+
+        ## NOTE: Materialize on CPU, vLLM manages its own GPU memory.
+        tokenizer, model = get_model(model_name, device_map="cpu")
+        model = get_vllm_model(model, tokenizer)
+
+        generate_fn = generate_output_vllm
+    else:
+        raise NotImplementedError(f"Unsupported backend '{backend}'.")
+
+    with accelerator.main_process_first():
+        data_splits = [
+            (
+                s,
+                sort_by_prompt_length(
+                    tokenize_prompts(ds, tokenizer, num_workers=num_workers)
+                ),
+            )
+            for s, ds in data_splits
+        ]
 
     generation_config = GenerationConfig(
         pad_token_id=tokenizer.pad_token_id,
         bos_token_id=tokenizer.bos_token_id,
         eos_token_id=tokenizer.eos_token_id,
         max_new_tokens=max_new_tokens,
+        ## NOTE: Explicit greedy path, model generation defaults may sample.
+        do_sample=False,
+        num_beams=1,
+        use_cache=True,
+        ## NOTE: Fixed-shape KV cache reused across batches, for compiled graphs.
+        cache_implementation="static" if compile_model else None,
     )
 
     for split_name, data in data_splits:
-        with accelerator.main_process_first():
-            if accelerator.is_main_process:
-                os.makedirs(f"{log_dir}/outputs/{split_name}")
+        ## NOTE: exist_ok covers concurrent ranks, no barrier needed.
+        os.makedirs(f"{log_dir}/outputs/{split_name}", exist_ok=True)
 
         # import pandas as pd
         # pd.DataFrame([data[i] for i in tqdm(range(len(data)))]).to_csv(
         #     f"{log_dir}/outputs/{split_name}/rows.csv", index=False
         # )
 
-        generate_output(
+        generate_fn(
             accelerator,
             model,
             tokenizer,
             get_loader(
                 data,
                 batch_size=batch_size,
+                num_workers=num_workers,
+                collate_fn=GenerationCollator(tokenizer),
                 pin_memory=True,
                 accelerator=accelerator,
             ),
@@ -109,8 +176,7 @@ def generate_query_label(
     query_format="roman_choice",
     strategy="substring",
 ):
-    for inputs in tqdm(loader):
-        inputs = [dict(zip(inputs.keys(), vals)) for vals in zip(*inputs.values())]
+    for inputs in tqdm(loader, disable=not accelerator.is_main_process):
         targets = [inp.pop("target") for inp in inputs]
         outputs = [inp.pop("output") for inp in inputs]
 
@@ -157,9 +223,7 @@ def generate_labels_main(
     if accelerator.is_main_process:
         wandb.config.update(config)
 
-    tokenizer, model = get_model(model_name)
-
-    del model
+    tokenizer = get_tokenizer(model_name)
 
     with accelerator.main_process_first():
         data_splits = get_dataset(
@@ -179,9 +243,11 @@ def generate_labels_main(
         ]
 
     for split_name, data in data_splits:
+        ## NOTE: Keep rows as dicts, no collate and transpose round-trip.
         loader = get_loader(
             data,
             batch_size=batch_size,
+            collate_fn=list,
             pin_memory=True,
             accelerator=accelerator,
         )
@@ -194,13 +260,9 @@ def generate_labels_main(
         )
 
         csv_path = f"{log_dir}/labels/{split_name}"
-        with accelerator.main_process_first():
-            if accelerator.is_main_process:
-                os.makedirs(csv_path)
+        os.makedirs(csv_path, exist_ok=True)
 
-        pd.DataFrame(label_generator).to_csv(
-            f"{csv_path}/{accelerator.process_index}.csv", index=False
-        )
+        write_csv_rows(label_generator, f"{csv_path}/{accelerator.process_index}.csv")
 
 
 @entrypoint(with_accelerator=True)
@@ -216,6 +278,8 @@ def generate_embeddings_main(
     batch_size=1,
     model_name=None,
 ):
+    configure_precision()
+
     config = {
         "seed": seed,
         "log_dir": log_dir,
@@ -235,7 +299,7 @@ def generate_embeddings_main(
     else:
         all_datasets = [dataset]
 
-    for dataset in tqdm(all_datasets):
+    for dataset in tqdm(all_datasets, disable=not accelerator.is_main_process):
         with accelerator.main_process_first():
             data_splits = get_dataset(
                 dataset,
@@ -254,20 +318,23 @@ def generate_embeddings_main(
                 if ds is not None
             ]
 
-        for split_name, data in tqdm(data_splits, leave=False):
+        for split_name, data in tqdm(
+            data_splits, leave=False, disable=not accelerator.is_main_process
+        ):
+            ## NOTE: Keep rows as dicts, no collate and transpose round-trip.
             loader = get_loader(
                 data,
                 batch_size=batch_size,
+                collate_fn=list,
                 pin_memory=True,
                 accelerator=accelerator,
             )
 
             all_embeddings = []
 
-            for inputs in tqdm(loader, leave=False):
-                inputs = [
-                    dict(zip(inputs.keys(), vals)) for vals in zip(*inputs.values())
-                ]
+            for inputs in tqdm(
+                loader, leave=False, disable=not accelerator.is_main_process
+            ):
                 outputs = [inp.pop("output") for inp in inputs]
                 targets = [inp.pop("target") for inp in inputs]
                 query_labels = [inp.pop("query_label") for inp in inputs]
@@ -287,7 +354,7 @@ def generate_embeddings_main(
             all_embeddings = torch.cat(all_embeddings, dim=0).cpu().numpy()
 
             save_dir = Path(log_dir) / "embeddings" / dataset / split_name
-            save_dir.mkdir(parents=True)
+            save_dir.mkdir(parents=True, exist_ok=True)
 
             np.save(save_dir / "embedding.npy", all_embeddings)
             logging.info(f"Saved embeddings to '{save_dir}'.")
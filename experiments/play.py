@@ -20,6 +20,7 @@ from peft.utils.other import infer_device
 
 from llm.datasets import LabeledStringDataCollator
 from llm.models import get_model
+from llm.models.llm_model_utils import compile_forward, get_attn_implementation
 
 
 @dataclass
@@ -222,8 +223,19 @@ MODEL_TYPE_TO_PEFT_MODEL_MAPPING["CALIBRATED_CAUSAL_LM"] = (
 
 
 @torch.inference_mode
-def main(model_name=None, max_new_tokens=100, use_query_only=False, use_temp=False):
-    tokenizer, model = get_model(model_name, device_map="auto")
+def main(
+    model_name=None,
+    max_new_tokens=100,
+    use_query_only=False,
+    use_temp=False,
+    compile_model=False,
+):
+    tokenizer, model = get_model(
+        model_name,
+        device_map="auto",
+        attn_implementation=get_attn_implementation(),
+        use_cache=True,
+    )
     if use_query_only:
         model = get_peft_model(model, CalibratedLoraConfig(), adapter_name="query")
     else:
@@ -236,12 +248,17 @@ def main(model_name=None, max_new_tokens=100, use_query_only=False, use_temp=Fal
 
     model.eval()
 
+    if compile_model:
+        model = compile_forward(model)
+
     generation_config = GenerationConfig(
         pad_token_id=tokenizer.pad_token_id,
         bos_token_id=tokenizer.bos_token_id,
         eos_token_id=tokenizer.eos_token_id,
         max_new_tokens=max_new_tokens,
         do_sample=False,
+        use_cache=True,
+        cache_implementation="static" if compile_model else None,
     )
 
     collate_fn = LabeledStringDataCollator(tokenizer)
@@ -5,10 +5,17 @@ from .registry import (
     get_dataset_attrs,
     list_datasets,
 )
-from .utils import get_loader, get_num_workers
+from .utils import (
+    get_loader,
+    get_num_proc,
+    get_num_workers,
+    sort_by_text_length,
+    tokenize_dataset,
+)
 
 from .llm_data_utils import (
     IGNORE_LABEL,
+    get_collate_fn,
     get_token_vec,
     LMText,
     LabeledStringDataCollator,
@@ -23,9 +30,13 @@ __all__ = [
     "get_dataset_attrs",
     "list_datasets",
     "get_loader",
+    "get_num_proc",
     "get_num_workers",
+    "sort_by_text_length",
+    "tokenize_dataset",
     "IGNORE_LABEL",
     "LabeledStringDataCollator",
+    "get_collate_fn",
     "get_token_vec",
     "LMText",
     "prepare_uncertainty_query",
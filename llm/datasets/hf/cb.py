@@ -80,7 +80,7 @@ def format_sample_prompt(prompt_dataset, format, kshot=1, seed=None):
 
     samples_idx = (
         np.random.default_rng(seed=seed)
-        .permutation(len(prompt_dataset))[:kshot]
+        .choice(len(prompt_dataset), min(kshot, len(prompt_dataset)), replace=False)
         .tolist()
     )
 
@@ -73,19 +73,30 @@ def format_sample(sample, format, with_query_label=False, seed=None):
     )
 
 
-def format_sample_prompt(prompt_dataset, format, kshot=1, seed=None):
+def format_batch(samples, indices, format, with_query_label=False, seed=None):
+    rows = [
+        format_sample(
+            dict(zip(samples.keys(), vals)),
+            format,
+            with_query_label=with_query_label,
+            seed=seed + idx,
+        ).to_pydict()
+        for vals, idx in zip(zip(*samples.values()), indices)
+    ]
+    return {k: [r[k] for r in rows] for k in rows[0].keys()}
+
+
+def format_sample_prompt(prompt_texts, format, kshot=1, seed=None):
     if not kshot:
         return ""
 
     samples_idx = (
         np.random.default_rng(seed=seed)
-        .permutation(len(prompt_dataset))[:kshot]
+        .choice(len(prompt_texts), min(kshot, len(prompt_texts)), replace=False)
         .tolist()
     )
 
-    fewshot_samples_prompt = [
-        str(LMText.from_(prompt_dataset[idx])) + "\n" for idx in samples_idx
-    ]
+    fewshot_samples_prompt = [prompt_texts[idx] + "\n" for idx in samples_idx]
 
     if format == PromptFormat.CHOICE:
         prompt = [
@@ -123,12 +134,15 @@ def get_hellaswag(
     dataset.pop("test", None)  ## NOTE: Test has no labels.
 
     dataset = dataset.map(
-        lambda sample, idx: format_sample(
-            sample, format, with_query_label=with_query_label, seed=seed + idx
-        ).to_pydict(),
+        lambda samples, indices: format_batch(
+            samples, indices, format, with_query_label=with_query_label, seed=seed
+        ),
+        batched=True,
+        batch_size=1000,
         with_indices=True,
         num_proc=num_workers,
         remove_columns=dataset.column_names["validation"],
+        features=LMText.features(with_query_label=with_query_label),
     )
 
     prompt_data = dataset.get("train")
@@ -138,13 +152,25 @@ def get_hellaswag(
         "test": eval_kshot,
     }
 
+    ## NOTE: Stringify few-shot candidates once, rows only index into them.
+    prompt_texts = (
+        [str(LMText.from_(sample)) for sample in prompt_data]
+        if any(prompt_kshot.values())
+        else []
+    )
+
     data_splits = {
         split: ds.map(
-            lambda _, idx: {
-                "prompt": format_sample_prompt(
-                    prompt_data, format, kshot=prompt_kshot[split], seed=seed + idx
-                )
+            lambda _, indices: {
+                "prompt": [
+                    format_sample_prompt(
+                        prompt_texts, format, kshot=prompt_kshot[split], seed=seed + idx
+                    )
+                    for idx in indices
+                ]
             },
+            batched=True,
+            batch_size=1000,
             with_indices=True,
             num_proc=num_workers,
         )
@@ -106,7 +106,7 @@ def format_sample_prompt(prompt_dataset, prompt_label, format, kshot=1, seed=Non
 
     samples_idx = (
         np.random.default_rng(seed=seed)
-        .permutation(len(prompt_dataset))[:kshot]
+        .choice(len(prompt_dataset), min(kshot, len(prompt_dataset)), replace=False)
         .tolist()
     )
 
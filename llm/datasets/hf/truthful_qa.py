@@ -3,31 +3,28 @@ import numpy as np
 from datasets import load_dataset
 
 from ..registry import register_dataset
+from ..utils import get_num_proc
 from ..llm_data_utils import LMText, PromptFormat
 
 
-def format_sample(sample, format, with_query_label=False, seed=None):
+def format_sample(sample, format, query_label=None, output_draw=None):
     target_prompt = "\nAnswer:"
 
     question = sample["question"]
     answer_map = sample["mc1_targets"]["choices"]
-    target_idx = np.array(sample["mc1_targets"]["labels"]).argmax().item()
+    labels = sample["mc1_targets"]["labels"]
+    ## NOTE: First max like np.argmax, without an ndarray per row.
+    target_idx = max(range(len(labels)), key=labels.__getitem__)
 
     output = None
-    query_label = (
-        np.random.default_rng(seed=seed).binomial(1, 0.5) if with_query_label else None
-    )
-    output_idx = (
-        target_idx
-        if query_label == 1
-        else (
-            np.random.default_rng(seed=seed).choice(
-                list(set(range(len(answer_map))) - set([target_idx]))
-            )
-            if query_label == 0
-            else None
-        )
-    )
+    output_idx = None
+    if query_label == 1:
+        output_idx = target_idx
+    elif query_label == 0:
+        ## NOTE: Draw among k - 1 slots and skip over the target.
+        output_idx = int(output_draw * (len(answer_map) - 1))
+        if output_idx >= target_idx:
+            output_idx += 1
 
     if format == PromptFormat.CHOICE:
         context = "\n".join(
@@ -69,19 +66,44 @@ def format_sample(sample, format, with_query_label=False, seed=None):
     )
 
 
-def format_sample_prompt(prompt_dataset, format, kshot=1, seed=None):
+def format_batch(
+    samples,
+    indices,
+    format,
+    query_labels=None,
+    output_draws=None,
+    seed=None,
+    prompt_texts=None,
+    kshot=0,
+):
+    rows = [
+        format_sample(
+            dict(zip(samples.keys(), vals)),
+            format,
+            query_label=None if query_labels is None else query_labels[idx],
+            output_draw=None if output_draws is None else output_draws[idx],
+        ).to_pydict()
+        for vals, idx in zip(zip(*samples.values()), indices)
+    ]
+    outputs = {k: [r[k] for r in rows] for k in rows[0].keys()}
+    outputs["prompt"] = [
+        format_sample_prompt(prompt_texts, format, kshot=kshot, seed=seed + idx)
+        for idx in indices
+    ]
+    return outputs
+
+
+def format_sample_prompt(prompt_texts, format, kshot=1, seed=None):
     if not kshot:
         return ""
 
     samples_idx = (
         np.random.default_rng(seed=seed)
-        .permutation(len(prompt_dataset))[:kshot]
+        .choice(len(prompt_texts), min(kshot, len(prompt_texts)), replace=False)
         .tolist()
     )
 
-    fewshot_samples_prompt = [
-        str(LMText.from_(prompt_dataset[idx])) + "\n" for idx in samples_idx
-    ]
+    fewshot_samples_prompt = [prompt_texts[idx] + "\n" for idx in samples_idx]
 
     if format == PromptFormat.CHOICE:
         prompt = [
@@ -116,33 +138,48 @@ def get_truthful_qa(
     if not use_cache:
         dataset.cleanup_cache_files()
 
-    dataset = dataset.map(
-        lambda sample, idx: format_sample(
-            sample, format, with_query_label=with_query_label, seed=seed + idx
-        ).to_pydict(),
-        with_indices=True,
-        num_proc=num_workers,
-        remove_columns=dataset.column_names["validation"],
-    )
-
-    prompt_data = dataset.get("validation")
     prompt_kshot = {
         "validation": eval_kshot,
         "test": eval_kshot,
     }
 
-    data_splits = {
-        split: ds.map(
-            lambda _, idx: {
-                "prompt": format_sample_prompt(
-                    prompt_data, format, kshot=prompt_kshot[split], seed=seed + idx
-                )
-            },
+    ## NOTE: Stringify few-shot candidates once, rows only index into them.
+    prompt_texts = (
+        [str(format_sample(sample, format)) for sample in dataset["validation"]]
+        if any(prompt_kshot.values())
+        else []
+    )
+
+    def _format_split(split, ds):
+        ## NOTE: One generator per split, instead of default_rng per row.
+        rng = np.random.default_rng(seed=seed)
+        query_labels, output_draws = (
+            (rng.binomial(1, 0.5, size=len(ds)), rng.random(size=len(ds)))
+            if with_query_label
+            else (None, None)
+        )
+
+        ## NOTE: Single pass formats rows and attaches few-shot prompts.
+        return ds.map(
+            lambda samples, indices: format_batch(
+                samples,
+                indices,
+                format,
+                query_labels=query_labels,
+                output_draws=output_draws,
+                seed=seed,
+                prompt_texts=prompt_texts,
+                kshot=prompt_kshot[split],
+            ),
+            batched=True,
+            batch_size=1000,
             with_indices=True,
-            num_proc=num_workers,
+            num_proc=get_num_proc(ds, num_workers),
+            remove_columns=ds.column_names,
+            features=LMText.features(with_query_label=with_query_label),
         )
-        for split, ds in dataset.items()
-    }
+
+    data_splits = {split: _format_split(split, ds) for split, ds in dataset.items()}
 
     train_data = data_splits.pop("train", None)
     val_data = data_splits.pop("validation", None)
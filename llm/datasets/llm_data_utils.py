@@ -1,8 +1,10 @@
 from enum import Enum
+from functools import lru_cache
 import dataclasses
 from dataclasses import dataclass, asdict as dataclassasdict
 import torch
 import transformers
+from datasets import Features, Value
 from datasets.formatting.formatting import LazyRow
 
 
@@ -38,6 +40,20 @@ class LMText:
     def field_names():
         return [f.name for f in dataclasses.fields(LMText)]
 
+    @staticmethod
+    def features(with_query_label=False):
+        ## NOTE: Explicit schema for to_pydict rows, skips Arrow type inference.
+        features = {
+            "context": Value("string"),
+            "prompt": Value("string"),
+            "target_prompt": Value("string"),
+            "target": Value("string"),
+        }
+        if with_query_label:
+            features["output"] = Value("string")
+            features["query_label"] = Value("int64")
+        return Features(features)
+
     @staticmethod
     def from_(instance):
         if isinstance(instance, LMText):
@@ -58,6 +74,8 @@ class LMText:
         return LMText(**instance)
 
 
+## NOTE: Constant per tokenizer, avoids get_vocab and tokenizing on every batch.
+@lru_cache(maxsize=None)
 def get_token_vec(tokenizer, format="roman_choice"):
     vocab = tokenizer.get_vocab()
 
@@ -65,7 +83,10 @@ def get_token_vec(tokenizer, format="roman_choice"):
         for t in raw_list:
             assert t in vocab, f"Cannot handle {t} as a single token."
 
-        return torch.tensor([tokenizer(t).input_ids[-1] for t in raw_list])
+        ## NOTE: One batched (fast) tokenizer call, BOS is never the last token.
+        return torch.tensor(
+            [ids[-1] for ids in tokenizer(raw_list, add_special_tokens=False).input_ids]
+        )
 
     if format == "bool":
         raw_strings = ["no", "yes"]
@@ -89,10 +110,16 @@ class LabeledStringDataCollator:
     tokenizer: transformers.PreTrainedTokenizer
     target_name: str = "target"
 
+    def __post_init__(self):
+        ## NOTE: Build once, reused by every batch.
+        self._tokenizer_args = self.get_tokenizer_args(self.tokenizer)
+
     @staticmethod
     def get_tokenizer_args(tokenizer):
         return dict(
             padding=True,
+            ## NOTE: Bucket shapes for tensor cores and compiled graphs.
+            pad_to_multiple_of=8,
             truncation=True,
             max_length=(
                 tokenizer.model_max_length
@@ -103,9 +130,7 @@ class LabeledStringDataCollator:
             return_length=True,
         )
 
-    def __call__(self, instances):
-        tokenizer_args = self.get_tokenizer_args(self.tokenizer)
-
+    def get_prompts(self, instances):
         prompts = [str(LMText.from_(instance)) for instance in instances]
 
         if (
@@ -128,27 +153,80 @@ class LabeledStringDataCollator:
                 for m in msgs
             ]
 
-        inputs = self.tokenizer(prompts, **tokenizer_args)
-        input_lengths = inputs.pop("length")
+        return prompts
+
+    def get_target_span(self, prompt, instance):
+        text = str(LMText.from_(instance))
+        prefix = str(
+            LMText.from_({k: v for k, v in instance.items() if k != self.target_name})
+        )
+
+        ## NOTE: Chat templates wrap the text, so find it whole and offset from
+        ## the known prefix. Searching for the target alone can match template text.
+        start = prompt.rfind(text)
+        if start < 0:
+            return len(prompt), len(prompt)
+        return start + len(prefix), start + len(text)
+
+    def pad(self, instances):
+        features = [
+            {k: instance[k] for k in ["input_ids", "attention_mask"]}
+            for instance in instances
+        ]
+        inputs = self.tokenizer.pad(
+            features, padding=True, pad_to_multiple_of=8, return_tensors="pt"
+        )
+
+        if "labels" in instances[0]:
+            L = inputs.get("input_ids").size(-1)
+            labels = torch.full((len(instances), L), IGNORE_LABEL)
+            for i, instance in enumerate(instances):
+                l = torch.as_tensor(instance["labels"])
+                if self.tokenizer.padding_side == "left":
+                    labels[i, L - l.size(-1) :] = l
+                else:
+                    labels[i, : l.size(-1)] = l
+            inputs["labels"] = labels
 
-        if self.target_name in instances[0]:
-            ## inputs without targets for labeling lengths.
-            un_inputs = self.tokenizer(
+        return inputs
+
+    def __call__(self, instances):
+        ## NOTE: Pre-tokenized by tokenize_dataset, only pad.
+        if "input_ids" in instances[0]:
+            return self.pad(instances)
+
+        prompts = self.get_prompts(instances)
+
+        has_targets = self.target_name in instances[0]
+
+        inputs = self.tokenizer(
+            prompts, **self._tokenizer_args, return_offsets_mapping=has_targets
+        )
+        inputs.pop("length")
+
+        if has_targets:
+            ## NOTE: Locate the target span by character offsets, single tokenizer pass.
+            target_spans = torch.tensor(
                 [
-                    str(
-                        LMText.from_(
-                            {k: v for k, v in instance.items() if k != self.target_name}
-                        )
-                    )
-                    for instance in instances
-                ],
-                **tokenizer_args,
-            )
-            un_input_lengths = un_inputs.pop("length")
+                    self.get_target_span(p, instance)
+                    for p, instance in zip(prompts, instances)
+                ]
+            ).unsqueeze(-2)
+
+            offsets = inputs.pop("offset_mapping")
 
             labels = inputs.get("input_ids").clone()
-            for i, l in enumerate(input_lengths - un_input_lengths):
-                labels[i, :-l] = IGNORE_LABEL
+            labels[
+                (offsets[..., 1] <= target_spans[..., 0])
+                | (offsets[..., 0] >= target_spans[..., 1])
+                | (inputs.get("attention_mask") == 0)
+            ] = IGNORE_LABEL
             inputs["labels"] = labels
 
         return inputs
+
+
+## NOTE: One collator per tokenizer, per-batch eval helpers reuse it.
+@lru_cache(maxsize=None)
+def get_collate_fn(tokenizer):
+    return LabeledStringDataCollator(tokenizer)
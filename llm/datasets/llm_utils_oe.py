@@ -1,5 +1,6 @@
 from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI, APIError
+import pandas as pd
 import torch
 import logging
 import time
@@ -135,13 +136,12 @@ def equivalency_grading(
 
 
 def sanitize_generations(generations):
-    def clean(g):
-        g = g.replace("\n\n", "\n")
-        g = g.replace(":\n", ":")
-        g = g.strip("\n").split("\n")[0]
-        return g
-
-    return list(map(clean, generations))
+    ## NOTE: Vectorized string ops over the whole batch.
+    g = pd.Series(list(generations), dtype=object)
+    g = g.str.replace("\n\n", "\n", regex=False)
+    g = g.str.replace(":\n", ":", regex=False)
+    g = g.str.strip("\n").str.split("\n", n=1).str[0]
+    return g.tolist()
 
 
 def prepare_uncertainty_query(
@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import numpy as np
 from datasets import concatenate_datasets
 
@@ -12,17 +14,19 @@ from ...random import FixedSeed
 from ..llm_data_utils import PromptFormat, LMText, LabeledStringDataCollator
 
 
+## NOTE: Registry is populated at import, safe to resolve once per format.
+@lru_cache(maxsize=None)
 def __get_train_dataset_names(format=None):
     format = PromptFormat(format)
 
-    dataset_names = [
+    excluded_names = set(["hellaswag"]) if format == PromptFormat.OE else set()
+
+    dataset_names = tuple(
         dname
         for dname in sorted(list_datasets())
-        if DatasetTag.EVAL_ONLY not in get_dataset_attrs(dname).get("tags", [])
-    ]
-
-    if format == PromptFormat.OE:
-        dataset_names = list(set(dataset_names) - set(["hellaswag"]))
+        if dname not in excluded_names
+        and DatasetTag.EVAL_ONLY not in get_dataset_attrs(dname).get("tags", [])
+    )
 
     return dataset_names
 
@@ -33,16 +37,23 @@ def get_combined_dataset(
     seed=None,
     complement=False,
     uniform=False,
+    max_threads=8,
     **kwargs,
 ):
-    all_train_data, all_val_data, all_test_data = [], [], []
-    for dataset in all_dataset_names:
-        train_data, val_data, test_data = get_dataset(
-            dataset,
-            seed=seed,
-            **kwargs,
+    ## NOTE: Loading is mostly I/O bound, threads overlap it across datasets.
+    ## Builders must not fork map workers from these threads. get_dataset drops None
+    ## kwargs, so pass 1, which datasets runs in-process.
+    kwargs["num_workers"] = 1
+    with ThreadPoolExecutor(max(1, min(max_threads, len(all_dataset_names)))) as p:
+        all_splits = list(
+            p.map(
+                lambda dataset: get_dataset(dataset, seed=seed, **kwargs),
+                all_dataset_names,
+            )
         )
 
+    all_train_data, all_val_data, all_test_data = [], [], []
+    for train_data, val_data, test_data in all_splits:
         [
             l.append(v) if v is not None else None
             for l, v in zip(
@@ -52,35 +63,32 @@ def get_combined_dataset(
         ]
 
     def _concat_datasets(datasets, comp=False, unf=False):
-        all_n = [len(ds) for ds in datasets]
-        total_n = min(max_n, sum(all_n))
+        all_n = np.array([len(ds) for ds in datasets])
+        total_n = min(max_n, all_n.sum())
 
         if unf:
-            equal_n = max_n // len(all_n)
-            select_n = [min(equal_n, len(ds)) for ds in datasets]
-
-            if comp:
-                return concatenate_datasets(
-                    [
-                        ds.select(range(n, N))
-                        for ds, N, n in zip(datasets, all_n, select_n)
-                        if n < N
-                    ]
-                )
-
-            return concatenate_datasets(
-                [ds.select(range(n)) for ds, n in zip(datasets, select_n)]
-            )
+            select_n = np.minimum(max_n // len(all_n), all_n)
+        else:
+            select_n = ((all_n / all_n.sum()) * total_n).astype(int)
 
-        select_n = ((np.array(all_n) / sum(all_n)) * total_n).astype(int)
+        starts, stops = (select_n, all_n) if comp else (np.zeros_like(all_n), select_n)
 
-        return concatenate_datasets(
-            [
-                ds.select(range(n, N) if comp else range(n))
-                for ds, N, n in zip(datasets, all_n, select_n)
-            ]
+        ## NOTE: Skip empty slices, they only add tables to the concatenation.
+        keep = stops > starts
+        if not keep.any():
+            return datasets[0].select([])
+
+        datasets = [ds for ds, k in zip(datasets, keep) if k]
+        all_n, starts, stops = all_n[keep], starts[keep], stops[keep]
+
+        ## NOTE: Single gather over the concatenated table, instead of one select per dataset.
+        offsets = np.cumsum(all_n) - all_n
+        select_idx = np.concatenate(
+            [np.arange(o + a, o + b) for o, a, b in zip(offsets, starts, stops)]
         )
 
+        return concatenate_datasets(datasets).select(select_idx)
+
     all_train_data = _concat_datasets(all_train_data, comp=complement, unf=uniform)
     all_val_data = _concat_datasets(all_val_data)
     all_test_data = _concat_datasets(all_test_data)
@@ -124,17 +132,30 @@ def get_all(
         )
 
     if max_token_length is not None:
-        tokenizer_args = LabeledStringDataCollator.get_tokenizer_args(tokenizer)
-
-        def token_length_filter(instance):
+        ## NOTE: Only lengths are needed, so no padding or tensors.
+        tokenizer_args = {
+            **LabeledStringDataCollator.get_tokenizer_args(tokenizer),
+            "padding": False,
+            "pad_to_multiple_of": None,
+            "return_tensors": None,
+        }
+
+        def token_length_filter(instances):
             inputs = tokenizer(
-                [str(LMText.from_(instance))],
+                [
+                    str(LMText.from_(dict(zip(instances.keys(), vals))))
+                    for vals in zip(*instances.values())
+                ],
                 **tokenizer_args,
             )
-            return inputs.get("input_ids").size(-1) <= max_token_length
+            return (np.array(inputs.get("length")) <= max_token_length).tolist()
 
-        tr = tr.filter(token_length_filter, num_proc=num_workers)
-        vl = vl.filter(token_length_filter, num_proc=num_workers)
+        tr = tr.filter(
+            token_length_filter, batched=True, batch_size=1000, num_proc=num_workers
+        )
+        vl = vl.filter(
+            token_length_filter, batched=True, batch_size=1000, num_proc=num_workers
+        )
 
     return tr, vl, None
 
@@ -1,5 +1,8 @@
 import torch
 from torch.utils.data import DataLoader, random_split
+from datasets import Dataset
+
+from .llm_data_utils import LabeledStringDataCollator
 
 
 def train_test_split(dataset, test_size=0.2, seed=None):
@@ -24,8 +27,22 @@ def get_num_workers(num_workers=4):
     return (num_workers + num_gpus_per_host - 1) // num_gpus_per_host
 
 
+def get_num_proc(dataset, num_workers=None, min_rows=10_000, rows_per_proc=1_000):
+    num_rows = dataset.num_rows
+    if isinstance(num_rows, dict):
+        num_rows = max(num_rows.values(), default=0)
+
+    ## NOTE: Small datasets are dominated by worker fork and IPC costs.
+    if not num_workers or num_rows < min_rows:
+        return None
+    return min(num_workers, num_rows // rows_per_proc)
+
+
 def get_loader(dataset, batch_size=128, num_workers=4, accelerator=None, **kwargs):
     num_workers = get_num_workers(num_workers=num_workers)
+    ## NOTE: Keep a few batches in flight so collation overlaps with compute.
+    if num_workers > 0:
+        kwargs.setdefault("prefetch_factor", 4)
     loader = DataLoader(
         dataset, batch_size=batch_size, num_workers=num_workers, **kwargs
     )
@@ -33,3 +50,57 @@ def get_loader(dataset, batch_size=128, num_workers=4, accelerator=None, **kwarg
         loader = accelerator.prepare(loader)
 
     return loader
+
+
+def sort_by_text_length(dataset, num_workers=None, batch_size=1000):
+    ## NOTE: Logits datasets and splits without text columns stay as they are.
+    if not isinstance(dataset, Dataset):
+        return dataset
+
+    fields = [k for k in ["context", "prompt"] if k in dataset.column_names]
+    if not fields:
+        return dataset
+
+    ## NOTE: Character count is a cheap proxy for token length.
+    def _length(samples):
+        return {
+            "length": [
+                sum(len(v or "") for v in vals)
+                for vals in zip(*[samples[k] for k in fields])
+            ]
+        }
+
+    ## NOTE: Longest first, so batches see few distinct padded shapes.
+    return (
+        dataset.map(
+            _length,
+            batched=True,
+            batch_size=batch_size,
+            num_proc=get_num_proc(dataset, num_workers),
+        )
+        .sort("length", reverse=True)
+        .remove_columns("length")
+    )
+
+
+def tokenize_dataset(dataset, tokenizer, num_workers=None, batch_size=1000):
+    collate_fn = LabeledStringDataCollator(tokenizer)
+
+    def _tokenize(samples):
+        instances = [dict(zip(samples.keys(), vals)) for vals in zip(*samples.values())]
+        inputs = collate_fn(instances)
+
+        ## NOTE: Store unpadded, LabeledStringDataCollator.pad re-pads per batch.
+        mask = inputs.get("attention_mask").bool()
+        return {
+            k: [v[m].tolist() for v, m in zip(inputs.get(k), mask)]
+            for k in inputs.keys()
+        }
+
+    return dataset.map(
+        _tokenize,
+        batched=True,
+        batch_size=batch_size,
+        num_proc=get_num_proc(dataset, num_workers),
+        remove_columns=dataset.column_names,
+    )
@@ -1,9 +1,9 @@
 from tqdm.auto import tqdm
 from collections import OrderedDict
 import torch
-from peft import PeftModel
 
-from ..datasets import LMText, LabeledStringDataCollator, prepare_uncertainty_query
+from ..datasets import LMText, get_collate_fn, prepare_uncertainty_query
+from ..models.peft import use_adapter
 from .common import (
     get_model_generations,
     save_metrics_data,
@@ -26,20 +26,16 @@ def get_classifier_inputs_via_embedding_model(model, lmtext_inputs, outputs):
 def get_classifier_inputs(
     accelerator, model, tokenizer, lmtext_inputs, outputs, adapter_name="query"
 ):
-    collate_fn = LabeledStringDataCollator(tokenizer)
+    collate_fn = get_collate_fn(tokenizer)
 
     inputs = [{**inp, "target": t} for inp, t in zip(lmtext_inputs, outputs)]
-    inputs = {k: v.to(accelerator.device) for k, v in collate_fn(inputs).items()}
+    inputs = {
+        k: v.to(accelerator.device, non_blocking=True)
+        for k, v in collate_fn(inputs).items()
+    }
 
-    if isinstance(model, PeftModel):
-        active_adapter = model.active_adapter
-        if adapter_name in model.peft_config:
-            model.set_adapter(adapter_name)
-
-    class_inputs = model(**inputs, output_hidden_states=True)
-
-    if isinstance(model, PeftModel):
-        model.set_adapter(active_adapter)
+    with use_adapter(model, adapter_name):
+        class_inputs = model(**inputs, output_hidden_states=True)
 
     target_layer = getattr(model.classifier_model, "target_layer", -1)
     class_inputs = class_inputs.hidden_states[target_layer][..., -1, :]
@@ -60,7 +56,7 @@ def evaluate_classifier(
 ):
     eval_data = OrderedDict([("logits", []), ("labels", [])])
 
-    for inputs in tqdm(loader):
+    for inputs in tqdm(loader, disable=not accelerator.is_main_process):
         extra_inputs = {
             k: v for k, v in inputs.items() if k not in LMText.field_names()
         }
@@ -86,7 +82,7 @@ def evaluate_classifier(
             strategy=grade_strategy,
             query_labels=class_labels,
         )
-        class_labels = class_labels.to(accelerator.device)
+        class_labels = class_labels.to(accelerator.device, non_blocking=True)
 
         if hasattr(model, "embedding_model"):
             if class_inputs is None:
@@ -101,15 +97,18 @@ def evaluate_classifier(
 
         class_logits = model.classifier_model(class_inputs)
 
+        ## NOTE: Keep gathered tensors on device, move to CPU once after the loop.
         [
-            eval_data[k].append(v.cpu())
+            eval_data[k].append(v)
             for k, v in zip(
                 eval_data.keys(),
                 accelerator.gather_for_metrics((class_logits, class_labels)),
             )
         ]
 
-    eval_data = OrderedDict({k: torch.cat(v, dim=0) for k, v in eval_data.items()})
+    eval_data = OrderedDict(
+        {k: torch.cat(v, dim=0).cpu() for k, v in eval_data.items()}
+    )
 
     all_metrics = compute_uncertainty_metrics(
         eval_data.get("labels"),
@@ -133,21 +132,24 @@ def evaluate_classifier_logits(
 ):
     eval_data = OrderedDict([("logits", []), ("labels", [])])
 
-    for inputs in tqdm(loader):
+    for inputs in tqdm(loader, disable=not accelerator.is_main_process):
         class_inputs = inputs.pop("embedding", None)
         class_labels = inputs.pop("query_label", None)
 
         class_logits = model(class_inputs)
 
+        ## NOTE: Keep gathered tensors on device, move to CPU once after the loop.
         [
-            eval_data[k].append(v.cpu())
+            eval_data[k].append(v)
             for k, v in zip(
                 eval_data.keys(),
                 accelerator.gather_for_metrics((class_logits, class_labels)),
             )
         ]
 
-    eval_data = OrderedDict({k: torch.cat(v, dim=0) for k, v in eval_data.items()})
+    eval_data = OrderedDict(
+        {k: torch.cat(v, dim=0).cpu() for k, v in eval_data.items()}
+    )
 
     all_metrics = compute_uncertainty_metrics(
         eval_data.get("labels"),
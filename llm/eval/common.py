@@ -4,10 +4,10 @@ from sklearn.metrics import roc_auc_score
 import torch
 import torch.nn.functional as F
 from transformers import GenerationConfig
-from peft import PeftModel
 
-from ..datasets import LabeledStringDataCollator
+from ..datasets import get_collate_fn
 from ..datasets.llm_utils_oe import sanitize_generations
+from ..models.peft import use_adapter
 from .third_party.calibration import calibration
 
 
@@ -45,15 +45,15 @@ def compute_uncertainty_metrics(labels, logits, prefix=""):
         labels: Shape (N,)
         logits: Shape (N, 2)
     """
-    p = logits.softmax(dim=-1)
+    p = logits.float().softmax(dim=-1)
 
-    pred = p.argmax(dim=-1)
+    p_max, pred = p.max(dim=-1)
     acc = (pred == labels).float().mean(dim=0)
 
     ece, _ = calibration(
         labels,
         pred,
-        p[torch.arange(p.size(0)), pred].float(),
+        p_max.float(),
     )
 
     auroc = compute_auroc(labels, p)
@@ -73,34 +73,30 @@ def get_model_generations(
     lmtext_inputs,
     max_new_tokens=None,
     adapter_name="default",
+    output_logits=False,
 ):
+    ## NOTE: Full-vocab logits per step only on request, hidden states are never used.
     config = GenerationConfig(
         pad_token_id=tokenizer.pad_token_id,
         bos_token_id=tokenizer.bos_token_id,
         eos_token_id=tokenizer.eos_token_id,
         max_new_tokens=max_new_tokens,
         do_sample=False,
+        use_cache=True,
         return_dict_in_generate=True,
-        output_logits=True,
-        output_hidden_states=True,
+        output_logits=output_logits,
     )
 
     if max_new_tokens is None:
         logging.warning(f"max_new_tokens is None.")
 
-    collate_fn = LabeledStringDataCollator(tokenizer)
+    collate_fn = get_collate_fn(tokenizer)
 
     inputs = collate_fn(lmtext_inputs)
-    inputs = {k: v.to(accelerator.device) for k, v in inputs.items()}
+    inputs = {k: v.to(accelerator.device, non_blocking=True) for k, v in inputs.items()}
 
-    if isinstance(model, PeftModel):
-        active_adapter = model.active_adapter
-        model.set_adapter(adapter_name)
-
-    outputs = model.generate(**inputs, generation_config=config)
-
-    if isinstance(model, PeftModel):
-        model.set_adapter(active_adapter)
+    with use_adapter(model, adapter_name):
+        outputs = model.generate(**inputs, generation_config=config)
 
     str_outputs = tokenizer.batch_decode(
         outputs.sequences[:, inputs.get("input_ids").size(-1) :],
@@ -3,7 +3,6 @@ import os
 from tqdm.auto import tqdm
 import torch
 import torch.nn.functional as F
-from peft import PeftModel
 import pandas as pd
 import numpy as np
 from transformers import GenerationConfig
@@ -15,6 +14,7 @@ from ..datasets.llm_utils_oe import (
     equivalency_grading,
     sanitize_generations,
 )
+from ..models.peft import use_adapter
 from .third_party.calibration import calibration
 
 
@@ -43,6 +43,7 @@ def evaluate_uncertainty_sampling_oe(
         eos_token_id=tokenizer.eos_token_id,
         max_new_tokens=max_new_tokens,
         do_sample=False,
+        use_cache=True,
     )
 
     generation_config_sampling = GenerationConfig(
@@ -52,9 +53,10 @@ def evaluate_uncertainty_sampling_oe(
         max_new_tokens=max_new_tokens,
         top_p=top_p,
         do_sample=True,
+        use_cache=True,
     )
 
-    with FixedSeed(seed):
+    with FixedSeed(seed), use_adapter(model, "default"):
         collate_fn = LabeledStringDataCollator(tokenizer)
 
         cs_q_labels = {c: [] for c in comparison_strategies}
@@ -75,17 +77,15 @@ def evaluate_uncertainty_sampling_oe(
             },
         }
 
-        for inputs in tqdm(loader):
+        for inputs in tqdm(loader, disable=not accelerator.is_main_process):
             inputs = [dict(zip(inputs.keys(), vals)) for vals in zip(*inputs.values())]
             targets = [inp.pop("target") for inp in inputs]
 
             generation_inputs = {
-                k: v.to(accelerator.device) for k, v in collate_fn(inputs).items()
+                k: v.to(accelerator.device, non_blocking=True)
+                for k, v in collate_fn(inputs).items()
             }
 
-            if isinstance(model, PeftModel):
-                model.set_adapter("default")
-
             generation_outputs = model.generate(
                 **generation_inputs, generation_config=generation_config
             )
@@ -111,6 +111,77 @@ def evaluate_uncertainty_sampling_oe(
 
             # custom clustering procedure differs from paper; we are using modern LLMs for equivalency, not the NLI classifier used in the paper.
             # full prompting strategy is in llm/datasets/llm_utils_oe.py
+            ## NOTE: All k samples in one batched generate, shared by all strategies.
+            sampling_generation_outputs = model.generate(
+                **generation_inputs,
+                generation_config=generation_config_sampling,
+                num_return_sequences=k,
+                return_dict_in_generate=True,
+                output_scores=True,
+            )
+
+            B = generation_inputs.get("input_ids").size(0)
+            all_sampling_sequences = sampling_generation_outputs["sequences"][
+                :, generation_inputs.get("input_ids").size(-1) :
+            ].view(B, k, -1)
+
+            # gets the max for each of the generated token among all log softmax probs in the vocab
+            all_sampling_log_probs = (
+                F.log_softmax(
+                    torch.stack(sampling_generation_outputs["scores"], dim=1),
+                    dim=-1,
+                )
+                .max(dim=-1)
+                .values.view(B, k, -1)
+            )
+
+            sampling_likelihoods = []
+            sampling_generations_list = []
+            for j in range(k):
+                sampling_generations = tokenizer.batch_decode(
+                    all_sampling_sequences[:, j],
+                    skip_special_tokens=True,
+                    clean_up_tokenization_spaces=False,
+                )
+
+                sampling_generations = sanitize_generations(sampling_generations)
+
+                sampling_log_probs = all_sampling_log_probs[:, j].detach().cpu().numpy()
+
+                # stop early at eos
+                eos_match_array = (
+                    all_sampling_sequences[:, j].detach().cpu().numpy()
+                    == tokenizer.eos_token_id
+                )
+
+                has_eos = np.any(eos_match_array, axis=-1)
+
+                # we want to get the index after the last valid index for each row
+                stop_index = np.where(
+                    has_eos,
+                    # If there are multiple maximal values in a reduced row then the indices of the first maximal value are returned.
+                    np.argmax(eos_match_array, axis=-1),
+                    sampling_log_probs.shape[-1],
+                )
+
+                # negative inf are now set to 0 to allow summing, then summed, then divided by stop_index, then exponentiated
+                # assumption: each sample produces nonzero text
+                sampling_likelihood = np.exp(
+                    np.sum(
+                        np.where(np.isinf(sampling_log_probs), 0, sampling_log_probs),
+                        axis=-1,
+                    )
+                    / stop_index
+                )
+
+                sampling_likelihoods.append(sampling_likelihood)
+                sampling_generations_list.append(sampling_generations)
+
+            sampling_likelihoods = np.stack(sampling_likelihoods, axis=-1)
+            normalized_sampling_likelihoods = sampling_likelihoods / np.sum(
+                sampling_likelihoods, axis=-1, keepdims=True
+            )
+
             for cs in comparison_strategies:
                 _, greedy_equivalency_labels, _ = prepare_uncertainty_query(
                     tokenizer,
@@ -125,74 +196,6 @@ def evaluate_uncertainty_sampling_oe(
                 )
                 # q_targets = [qi.pop("target") for qi in q_inputs]
 
-                sampling_likelihoods = []
-                sampling_generations_list = []
-                for _ in range(k):
-                    sampling_generation_outputs = model.generate(
-                        **generation_inputs,
-                        generation_config=generation_config_sampling,
-                        return_dict_in_generate=True,
-                        output_scores=True,
-                    )
-
-                    sampling_generations = tokenizer.batch_decode(
-                        sampling_generation_outputs["sequences"][
-                            :, generation_inputs.get("input_ids").size(-1) :
-                        ],
-                        skip_special_tokens=True,
-                        clean_up_tokenization_spaces=False,
-                    )
-
-                    sampling_generations = sanitize_generations(sampling_generations)
-
-                    # gets the max for each of the generated token among all log softmax probs in the vocab
-                    sampling_log_probs = np.max(
-                        F.log_softmax(
-                            torch.stack(sampling_generation_outputs["scores"], dim=1),
-                            dim=-1,
-                        )
-                        .detach()
-                        .cpu()
-                        .numpy(),
-                        axis=-1,
-                    )
-
-                    # stop early at eos
-                    eos_match_array = (
-                        sampling_generation_outputs["sequences"][
-                            :, generation_inputs.get("input_ids").size(-1) :
-                        ]
-                        .detach()
-                        .cpu()
-                        .numpy()
-                        == tokenizer.eos_token_id
-                    )
-
-                    has_eos = np.any(eos_match_array, axis=-1)
-
-                    # we want to get the index after the last valid index for each row
-                    stop_index = np.where(
-                        has_eos,
-                        # If there are multiple maximal values in a reduced row then the indices of the first maximal value are returned.
-                        np.argmax(eos_match_array, axis=-1),
-                        sampling_log_probs.shape[-1],
-                    )
-
-                    # negative inf are now set to 0 to allow summing, then summed, then divided by stop_index, then exponentiated
-                    # assumption: each sample produces nonzero text
-                    sampling_likelihood = np.exp(
-                        np.sum(
-                            np.where(
-                                np.isinf(sampling_log_probs), 0, sampling_log_probs
-                            ),
-                            axis=-1,
-                        )
-                        / stop_index
-                    )
-
-                    sampling_likelihoods.append(sampling_likelihood)
-                    sampling_generations_list.append(sampling_generations)
-
                 sampling_equivalencies = np.reshape(
                     equivalency_grading(
                         inputs * k,
@@ -206,11 +209,6 @@ def evaluate_uncertainty_sampling_oe(
                     (-1, k),
                 )
 
-                sampling_likelihoods = np.stack(sampling_likelihoods, axis=-1)
-                normalized_sampling_likelihoods = sampling_likelihoods / np.sum(
-                    sampling_likelihoods, axis=-1, keepdims=True
-                )
-
                 summed_likelihood = np.sum(
                     np.where(
                         sampling_equivalencies,
@@ -365,6 +363,7 @@ def evaluate_verbal_elicitation_oe(
         eos_token_id=tokenizer.eos_token_id,
         max_new_tokens=max_new_tokens,
         do_sample=False,
+        use_cache=True,
     )
 
     collate_fn = LabeledStringDataCollator(tokenizer)
@@ -377,7 +376,7 @@ def evaluate_verbal_elicitation_oe(
         "evals": {c: {"q_labels": [], "q_logits": []} for c in comparison_strategies},
     }
 
-    for inputs in tqdm(loader):
+    for inputs in tqdm(loader, disable=not accelerator.is_main_process):
         inputs.pop("embedding", None)
         inputs = [dict(zip(inputs.keys(), vals)) for vals in zip(*inputs.values())]
         targets = [inp.pop("target") for inp in inputs]
@@ -394,55 +393,52 @@ def evaluate_verbal_elicitation_oe(
             ]
         )
 
-        for cs in comparison_strategies:
-            q_labels = (
-                [inp.pop("query_label").item() for inp in inputs]
-                if "query_label" in inputs[0]
-                else None
-            )
-            q_labels = torch.Tensor(q_labels).to(accelerator.device)
-
-            uncertainty_prompt = VERBAL_ELICITATION_UNC_QUERIES
+        ## NOTE: The query pass is the same for every comparison strategy.
+        q_labels = (
+            [inp.pop("query_label").item() for inp in inputs]
+            if "query_label" in inputs[0]
+            else None
+        )
+        q_labels = torch.tensor(q_labels, dtype=torch.float, device=accelerator.device)
 
-            contexts = [str(LMText.from_(inp)) for inp in inputs]
+        uncertainty_prompt = VERBAL_ELICITATION_UNC_QUERIES
 
-            q_inputs = [
-                {
-                    "context": f"{c + ' ' + p.strip()}\n\n",
-                    "target_prompt": uncertainty_prompt,
-                }
-                for c, p in zip(contexts, generations)
-            ]
+        contexts = [str(LMText.from_(inp)) for inp in inputs]
 
-            gen_inputs = {
-                k: v.to(accelerator.device) for k, v in collate_fn(q_inputs).items()
+        q_inputs = [
+            {
+                "context": f"{c + ' ' + p.strip()}\n\n",
+                "target_prompt": uncertainty_prompt,
             }
+            for c, p in zip(contexts, generations)
+        ]
 
-            gen_output = model.generate(
-                **gen_inputs, generation_config=generation_config
-            )
+        gen_inputs = {
+            k: v.to(accelerator.device, non_blocking=True)
+            for k, v in collate_fn(q_inputs).items()
+        }
 
-            gen_output = [
-                o[i.size(0) :] for o, i in zip(gen_output, gen_inputs["input_ids"])
-            ]
+        gen_output = model.generate(**gen_inputs, generation_config=generation_config)
 
-            gen_output = tokenizer.batch_decode(
-                gen_output,
-                skip_special_tokens=True,
-                clean_up_tokenization_spaces=False,
-            )
+        gen_output = tokenizer.batch_decode(
+            gen_output[:, gen_inputs.get("input_ids").size(-1) :],
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=False,
+        )
 
-            print(gen_output)
+        logging.debug(gen_output)
 
-            q_logits = torch.cat(
-                [parse_verbal_elicitation_oe(x)[1] for x in gen_output]
-            ).to(accelerator.device)
+        q_logits = torch.cat(
+            [parse_verbal_elicitation_oe(x)[1] for x in gen_output]
+        ).to(accelerator.device)
 
+        for cs in comparison_strategies:
             all_data["evals"][cs]["q_labels"].append(q_labels.detach())
             all_data["evals"][cs]["q_logits"].append(q_logits.detach())
 
+            ## NOTE: Keep gathered tensors on device, move to CPU once after the loop.
             [
-                l.append(v.cpu())
+                l.append(v)
                 for l, v in zip(
                     (cs_q_labels[cs], cs_q_logits[cs]),
                     accelerator.gather_for_metrics((q_labels, q_logits)),
@@ -451,24 +447,26 @@ def evaluate_verbal_elicitation_oe(
 
     metrics_dict = {}
     for cs in comparison_strategies:
-        q_labels = torch.cat(cs_q_labels[cs], dim=0)
-        q_p = torch.cat(cs_q_logits[cs], dim=0).softmax(dim=-1)
+        q_labels = torch.cat(cs_q_labels[cs], dim=0).cpu()
+        q_logits = torch.cat(cs_q_logits[cs], dim=0).cpu().float()
+
+        ## NOTE: Only top-1 and column 1 probabilities are read, skip the full softmax.
+        q_lse = q_logits.logsumexp(dim=-1)
+        q_logit_max, q_pred = q_logits.max(dim=-1)
+        q_p_max = (q_logit_max - q_lse).exp()
+        q_p_1 = (q_logits[:, 1] - q_lse).exp()
 
         acc = q_labels.float().mean(dim=0)
-        q_pred = q_p.argmax(dim=-1)
         q_acc = (q_pred == q_labels).float().mean(dim=0)
 
         q_ece, _ = calibration(
             q_labels,
             q_pred,
-            q_p[torch.arange(q_p.size(0)), q_pred].float(),
+            q_p_max,
         )
 
         try:
-            q_auroc = roc_auc_score(
-                q_labels.cpu(),
-                q_p[torch.arange(q_p.size(0)), 1].float().cpu(),
-            )
+            q_auroc = roc_auc_score(q_labels, q_p_1)
         except ValueError:
             q_auroc = float("nan")
             logging.exception("AUROC calculation failed.", exc_info=True)
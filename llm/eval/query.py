@@ -4,11 +4,12 @@ from collections import OrderedDict
 from peft import PeftModel
 
 from ..datasets import (
-    LabeledStringDataCollator,
+    get_collate_fn,
     LMText,
     prepare_uncertainty_query,
     get_token_vec,
 )
+from ..models.peft import use_adapter
 from .common import (
     get_model_generations,
     compute_uncertainty_metrics,
@@ -38,22 +39,34 @@ def get_query_generations(
         format=query_format,
     )
 
-    collate_fn = LabeledStringDataCollator(tokenizer)
+    collate_fn = get_collate_fn(tokenizer)
 
     q_inputs = collate_fn(q_inputs)
-    q_inputs = {k: v.to(accelerator.device) for k, v in q_inputs.items()}
-
-    if isinstance(model, PeftModel):
-        active_adapter = model.active_adapter
-        if adapter_name in model.peft_config:
-            model.set_adapter(adapter_name)
-
-    q_generation_outputs = model(**q_inputs)
+    q_inputs = {
+        k: v.to(accelerator.device, non_blocking=True) for k, v in q_inputs.items()
+    }
+
+    ## NOTE: Run the decoder only, lm_head is applied below to one position per row.
+    lm = model.get_base_model() if isinstance(model, PeftModel) else model
+    with use_adapter(model, adapter_name):
+        q_hidden = lm.get_decoder()(
+            input_ids=q_inputs.get("input_ids"),
+            attention_mask=q_inputs.get("attention_mask"),
+        ).last_hidden_state
+
+        ## NOTE: Last non-pad position, so batched queries work with either padding side.
+        q_mask = q_inputs.get("attention_mask")
+        q_last = q_mask.size(-1) - 1 - q_mask.flip(-1).argmax(dim=-1)
+
+        ## NOTE: The decoder skips the root hook, its output may sit on another device.
+        q_hidden = q_hidden[
+            torch.arange(q_mask.size(0), device=q_hidden.device),
+            q_last.to(q_hidden.device),
+        ]
 
-    if isinstance(model, PeftModel):
-        model.set_adapter(active_adapter)
+        q_logits = lm.get_output_embeddings()(q_hidden)
 
-    q_logits = q_generation_outputs.logits[..., -1, q_token_vec]
+    q_logits = q_logits[..., q_token_vec.to(q_logits.device)].to(accelerator.device)
 
     if hasattr(model, "query_temperature_model"):
         q_logits = model.query_temperature_model(q_logits)
@@ -72,12 +85,20 @@ def evaluate_query(
     grade_strategy=None,
     **_,
 ):
-    eval_data = OrderedDict([("q_logits", []), ("q_labels", [])])
+    eval_data = OrderedDict([("q_logits", None), ("q_labels", None)])
+    eval_offset = 0
     logits_eval_data = OrderedDict([("logits", []), ("labels", [])])
 
     # modiste_data = OrderedDict([("output", []), ("example_idx", []), ("orig_example_idx", [])])
 
-    for inputs in tqdm(loader):
+    ## NOTE: Build once, get_token_vec materializes the full vocabulary.
+    choice_vec = get_token_vec(tokenizer, format="choice")
+
+    ## NOTE: Token id to choice index, unknown ids map to 0 like the argmax did.
+    choice_idx = torch.zeros(len(tokenizer), dtype=torch.long)
+    choice_idx[choice_vec] = torch.arange(choice_vec.size(0))
+
+    for inputs in tqdm(loader, disable=not accelerator.is_main_process):
         extra_inputs = {
             k: v for k, v in inputs.items() if k not in LMText.field_names()
         }
@@ -91,27 +112,26 @@ def evaluate_query(
 
         if outputs is None:
             outputs, __generations = get_model_generations(
-                accelerator, model, tokenizer, inputs, max_new_tokens=max_new_tokens
+                accelerator,
+                model,
+                tokenizer,
+                inputs,
+                max_new_tokens=max_new_tokens,
+                output_logits=max_new_tokens == 1,
             )
 
             ## Token-level metrics only for single-token generation.
             if max_new_tokens == 1:
-                choice_vec = get_token_vec(tokenizer, format="choice")
-
                 labels = tokenizer(targets, return_tensors="pt").get("input_ids")[:, 1]
-                labels = (
-                    (labels.unsqueeze(dim=-1) == choice_vec.unsqueeze(dim=0))
-                    .long()
-                    .argmax(dim=-1)
-                )
+                labels = choice_idx[labels]
 
                 logits = __generations.logits[-1][..., choice_vec]
 
                 [
-                    logits_eval_data[k].append(v.cpu())
+                    logits_eval_data[k].append(v)
                     for k, v in zip(
                         logits_eval_data.keys(),
-                        accelerator.gather_for_metrics((logits, labels)),
+                        accelerator.gather_for_metrics((logits.half(), labels)),
                     )
                 ]
 
@@ -126,13 +146,17 @@ def evaluate_query(
             query_labels=q_labels,
         )
 
-        [
-            eval_data[k].append(v.cpu())
-            for k, v in zip(
-                eval_data.keys(),
-                accelerator.gather_for_metrics((q_logits, q_labels)),
+        ## NOTE: Write into buffers sized once to the dataset, no concat at the end.
+        ## Logits travel as fp16, metrics upcast again on the host.
+        gathered = accelerator.gather_for_metrics((q_logits.half(), q_labels))
+        if eval_data["q_logits"] is None:
+            eval_data = OrderedDict(
+                (k, v.new_empty((len(loader.dataset), *v.shape[1:])))
+                for k, v in zip(eval_data.keys(), gathered)
             )
-        ]
+        for k, v in zip(eval_data.keys(), gathered):
+            eval_data[k][eval_offset : eval_offset + v.size(0)] = v
+        eval_offset += gathered[0].size(0)
 
         # [
         #     modiste_data[k].extend(v.cpu().numpy().tolist())
@@ -140,7 +164,7 @@ def evaluate_query(
         # ]
         # modiste_data["output"].extend(outputs)
 
-    eval_data = OrderedDict({k: torch.cat(v, dim=0) for k, v in eval_data.items()})
+    eval_data = OrderedDict({k: v[:eval_offset].cpu() for k, v in eval_data.items()})
 
     all_metrics = compute_uncertainty_metrics(
         eval_data.get("q_labels"),
@@ -151,7 +175,7 @@ def evaluate_query(
     save_metrics_data(eval_data, log_dir=log_dir, filename="query_data.bin")
 
     logits_eval_data = OrderedDict(
-        {k: torch.cat(v, dim=0) for k, v in logits_eval_data.items() if len(v)}
+        {k: torch.cat(v, dim=0).cpu() for k, v in logits_eval_data.items() if len(v)}
     )
     if logits_eval_data:
         logits_eval_data["choice_vec"] = choice_vec
@@ -183,18 +207,21 @@ def evaluate_query_logits(
 ):
     eval_data = OrderedDict([("q_logits", []), ("q_labels", [])])
 
-    for q_logits, q_labels in tqdm(loader):
+    for q_logits, q_labels in tqdm(loader, disable=not accelerator.is_main_process):
         q_logits = q_logits / T
 
+        ## NOTE: Keep gathered tensors on device, move to CPU once after the loop.
         [
-            eval_data[k].append(v.cpu())
+            eval_data[k].append(v)
             for k, v in zip(
                 eval_data.keys(),
                 accelerator.gather_for_metrics((q_logits, q_labels)),
             )
         ]
 
-    eval_data = OrderedDict({k: torch.cat(v, dim=0) for k, v in eval_data.items()})
+    eval_data = OrderedDict(
+        {k: torch.cat(v, dim=0).cpu() for k, v in eval_data.items()}
+    )
 
     all_metrics = compute_uncertainty_metrics(
         eval_data.get("q_labels"),
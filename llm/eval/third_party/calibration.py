@@ -48,26 +48,21 @@ def calibration(y, class_pred, conf, num_bins=10):
     # conf = np.max(p_mean, axis=1)
     # Convert y from one-hot encoding to the number of the class
     # y = np.argmax(y, axis=1)
-    # Storage
-    acc_tab = np.zeros(num_bins)  # empirical (true) confidence
-    mean_conf = np.zeros(num_bins)  # predicted confidence
-    nb_items_bin = np.zeros(num_bins)  # number of items in the bins
     tau_tab = np.linspace(0, 1, num_bins + 1)  # confidence bins
-    for i in np.arange(num_bins):  # iterate over the bins
-        # select the items where the predicted max probability falls in the bin
-        # [tau_tab[i], tau_tab[i + 1)]
-        sec = (tau_tab[i + 1] > conf) & (conf >= tau_tab[i])
-        nb_items_bin[i] = np.sum(sec)  # Number of items in the bin
-        # select the predicted classes, and the true classes
-        class_pred_sec, y_sec = class_pred[sec], y[sec]
-        # average of the predicted max probabilities
-        mean_conf[i] = np.mean(conf[sec]) if nb_items_bin[i] > 0 else np.nan
-        # compute the empirical confidence
-        acc_tab[i] = np.mean(class_pred_sec == y_sec) if nb_items_bin[i] > 0 else np.nan
+    # bin index i such that tau_tab[i] <= conf < tau_tab[i + 1], single pass
+    bin_idx = np.searchsorted(tau_tab, conf, side="right") - 1
+    sec = (bin_idx >= 0) & (bin_idx < num_bins)
+    bin_idx = bin_idx[sec]
+    nb_items_bin = np.bincount(bin_idx, minlength=num_bins)  # items per bin
+    # predicted confidence and empirical (true) confidence per bin
+    conf_sum = np.bincount(bin_idx, weights=conf[sec], minlength=num_bins)
+    acc_sum = np.bincount(
+        bin_idx, weights=(class_pred == y)[sec].astype(float), minlength=num_bins
+    )
 
     # Cleaning
-    mean_conf = mean_conf[nb_items_bin > 0]
-    acc_tab = acc_tab[nb_items_bin > 0]
+    mean_conf = conf_sum[nb_items_bin > 0] / nb_items_bin[nb_items_bin > 0]
+    acc_tab = acc_sum[nb_items_bin > 0] / nb_items_bin[nb_items_bin > 0]
     nb_items_bin = nb_items_bin[nb_items_bin > 0]
 
     if len(nb_items_bin) == 0:
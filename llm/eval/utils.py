@@ -2,7 +2,7 @@ import logging
 from functools import partial
 
 from ..logging import Timer
-from ..datasets import get_dataset, get_loader
+from ..datasets import get_dataset, get_loader, sort_by_text_length
 from .oe import evaluate_uncertainty_sampling_oe, evaluate_verbal_elicitation_oe
 from .query import evaluate_query, evaluate_query_logits
 from .classifier import evaluate_classifier, evaluate_classifier_logits
@@ -165,6 +165,7 @@ def evaluate_dataset(
     prompt_style=None,
     log_dir=None,
     evaluate_fn=None,
+    sort_by_length=False,
 ):
     if dataset is not None:
         with accelerator.main_process_first():
@@ -271,6 +272,11 @@ def evaluate_dataset(
     all_metrics = []
 
     for split_name, data in data_splits:
+        ## NOTE: Length-sorted batches cut padding and keep compiled shapes few.
+        if sort_by_length:
+            with accelerator.main_process_first():
+                data = sort_by_text_length(data, num_workers=num_workers)
+
         with Timer() as train_timer:
             metrics = evaluate_fn(
                 accelerator,
@@ -279,6 +285,7 @@ def evaluate_dataset(
                 get_loader(
                     data,
                     batch_size=batch_size,
+                    num_workers=num_workers,
                     pin_memory=True,
                     accelerator=accelerator,
                 ),
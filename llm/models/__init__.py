@@ -1,10 +1,17 @@
-from .registry import register_model, get_model, get_model_attrs, list_models
+from .registry import (
+    register_model,
+    get_model,
+    get_model_attrs,
+    get_tokenizer,
+    list_models,
+)
 
 
 __all__ = [
     "register_model",
     "get_model",
     "get_model_attrs",
+    "get_tokenizer",
     "list_models",
 ]
 
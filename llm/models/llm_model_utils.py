@@ -1,6 +1,47 @@
+import importlib.util
+import torch
+from peft import PeftModel
+
+
 DEFAULT_PAD_TOKEN = "[PAD]"
 
 
+def get_attn_implementation():
+    if importlib.util.find_spec("flash_attn") is not None:
+        return "flash_attention_2"
+    return "sdpa"
+
+
+def compile_forward(model):
+    ## NOTE: generate() calls the inner LM forward, compile that in-place.
+    lm = model.get_base_model() if isinstance(model, PeftModel) else model
+    lm.forward = torch.compile(
+        lm.forward, mode="reduce-overhead", fullgraph=False, dynamic=True
+    )
+
+    ## NOTE: Query scoring runs the decoder without lm_head, compile it as well.
+    decoder = lm.get_decoder()
+    decoder.forward = torch.compile(
+        decoder.forward, mode="reduce-overhead", fullgraph=False, dynamic=True
+    )
+    return model
+
+
+def quantize_int8_weight_only(model):
+    ## NOTE: Fused int8 matmul kernels are only selected under torch.compile.
+    from torchao.quantization import quantize_, int8_weight_only
+
+    quantize_(model, int8_weight_only())
+    return model
+
+
+def __init_new_rows(embeddings, extra_token_count):
+    mean_embedding = embeddings[:-extra_token_count].mean(
+        dim=0, keepdim=True, dtype=torch.float32
+    )
+    embeddings[-extra_token_count:].copy_(mean_embedding.expand(extra_token_count, -1))
+
+
 def resize_token_embeddings(tokenizer, model):
     extra_token_count = len(tokenizer) - model.get_input_embeddings().weight.data.size(
         0
@@ -9,13 +50,9 @@ def resize_token_embeddings(tokenizer, model):
         model.resize_token_embeddings(len(tokenizer))
 
         input_embeddings = model.get_input_embeddings().weight.data
-
-        input_embeddings[-extra_token_count:] = input_embeddings[
-            :-extra_token_count
-        ].mean(dim=0, keepdim=True)
+        __init_new_rows(input_embeddings, extra_token_count)
 
         output_embeddings = model.get_output_embeddings().weight.data
-
-        output_embeddings[-extra_token_count:] = output_embeddings[
-            :-extra_token_count
-        ].mean(dim=0, keepdim=True)
+        ## NOTE: Tied embeddings share storage, already initialized.
+        if output_embeddings.data_ptr() != input_embeddings.data_ptr():
+            __init_new_rows(output_embeddings, extra_token_count)
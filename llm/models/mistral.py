@@ -67,23 +67,34 @@ def create_model(
     tokenizer=None,
     use_int8=False,
     use_int4=False,
+    int8_threshold=6.0,
     **kwargs,
 ):
+    torch_dtype = torch_dtype or (
+        torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    )
+
     quantization_config = None
     if use_int4 or use_int8:
         from transformers import BitsAndBytesConfig
 
         quantization_config = BitsAndBytesConfig(
             load_in_4bit=use_int4,
-            load_in_8bit=use_int8,
+            load_in_8bit=use_int8 and not use_int4,
+            ## NOTE: 0.0 disables the outlier decomposition, faster for inference.
+            llm_int8_threshold=int8_threshold,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_compute_dtype=torch_dtype,
         )
 
     model = MistralForCausalLM.from_pretrained(
         model_dir or f"mistralai/{kind}",
-        torch_dtype=torch_dtype
-        or (torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16),
+        torch_dtype=torch_dtype,
         quantization_config=quantization_config,
         use_cache=use_cache,
+        ## NOTE: Load weights straight into the target dtype, no full fp32 copy.
+        low_cpu_mem_usage=True,
         **kwargs,
     )
 
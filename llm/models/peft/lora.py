@@ -1,4 +1,4 @@
-from peft import TaskType, LoraConfig, get_peft_model
+from peft import PeftModel, TaskType, LoraConfig, get_peft_model
 
 from .utils import get_peft_model_from_checkpoint
 
@@ -7,13 +7,26 @@ class use_adapter:
     def __init__(self, model, adapter_name):
         self.model = model
         self.adapter_name = adapter_name
-        self.active_adapter = model.active_adapter
+        self.active_adapter = None
+        self.disabled_adapter = None
 
     def __enter__(self):
-        self.model.set_adapter(self.adapter_name)
+        if not isinstance(self.model, PeftModel):
+            return
 
-    def __exit__(self, *_):
-        self.model.set_adapter(self.active_adapter)
+        if self.adapter_name in self.model.peft_config:
+            self.active_adapter = self.model.active_adapter
+            self.model.set_adapter(self.adapter_name)
+        else:
+            ## NOTE: Adapters not attached are identity, run the base model.
+            self.disabled_adapter = self.model.disable_adapter()
+            self.disabled_adapter.__enter__()
+
+    def __exit__(self, *args):
+        if self.active_adapter is not None:
+            self.model.set_adapter(self.active_adapter)
+        if self.disabled_adapter is not None:
+            self.disabled_adapter.__exit__(*args)
 
 
 def get_lora_model(
@@ -26,6 +39,10 @@ def get_lora_model(
     adapter_name="default",
     **config_args,
 ):
+    if is_trainable:
+        ## NOTE: Lets gradients flow through checkpointed frozen base layers.
+        model.enable_input_require_grads()
+
     if peft_id_or_dir is not None:
         return get_peft_model_from_checkpoint(
             model,
@@ -57,6 +57,12 @@ def get_model(model_name, **kwargs):
     return model
 
 
+def get_tokenizer(model_name, **kwargs):
+    ## NOTE: Resolve the "<key>_tokenizer" endpoint, without loading model weights.
+    key, *kind = model_name.split(":", 1)
+    return get_model(":".join([f"{key}_tokenizer", *kind]), **kwargs)
+
+
 def list_models():
     return [
         model_name
@@ -0,0 +1,7 @@
+import torch
+
+
+def configure_precision():
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision("high")
@@ -1,14 +1,14 @@
 import os
+import math
 from dataclasses import dataclass, field
+from functools import partial
 from tqdm.auto import tqdm
 import torch
-from torch.distributions import Categorical, kl_divergence
 import torch.nn.functional as F
 from torch.utils.data import default_collate
 from transformers.trainer import (
     logger,
     unwrap_model,
-    TRAINING_ARGS_NAME,
     Trainer,
     TrainingArguments,
 )
@@ -18,6 +18,26 @@ from ..datasets import (
     LabeledStringDataCollator,
     prepare_uncertainty_query,
 )
+from .utils import save_training_args
+
+
+def topk_log_probs(logits, index):
+    log_p = (logits.gather(-1, index) - logits.logsumexp(dim=-1, keepdim=True)).float()
+
+    ## NOTE: Residual bucket holds the truncated tail, so the result stays normalized.
+    log_rest = torch.log1p(-log_p.exp().sum(dim=-1, keepdim=True).clamp(max=1 - 1e-6))
+
+    return torch.cat([log_p, log_rest], dim=-1)
+
+
+def collate_with_lm_inputs(collate_fn, instances):
+    batch = default_collate(instances)
+
+    ## NOTE: Tokenize LM inputs in the loader workers, not in compute_loss.
+    if "query_label" not in instances[0]:
+        batch["lm_inputs"] = dict(collate_fn(instances))
+
+    return batch
 
 
 class CalibrationTuner(Trainer):
@@ -45,6 +65,7 @@ class CalibrationTuner(Trainer):
         unc_label_smoothing: float = field(default=0.0)
         kl_type: str = field(default="jsd")
         kl_decay: float = field(default=0.0)
+        kl_topk: int = field(default=0)
         scale_temp: bool = field(default=False)
 
     def __init__(
@@ -66,7 +87,7 @@ class CalibrationTuner(Trainer):
             args=args,
             tokenizer=tokenizer,
             train_dataset=train_dataset,
-            data_collator=default_collate,
+            data_collator=partial(collate_with_lm_inputs, self._collate_fn),
         )
 
     def _wrap_model(self, *args, **kwargs):
@@ -81,23 +102,35 @@ class CalibrationTuner(Trainer):
 
         return super()._wrap_model(*args, **kwargs)
 
-    def compute_lm_loss(self, model, inputs, targets):
+    def compute_lm_loss(self, model, inputs, targets, lm_inputs=None):
         if "query_label" in inputs[0]:
             predictions = [inp.pop("output") for inp in inputs]
             lm_loss = torch.tensor(0.0)
+            lm_outputs = None
         else:
-            generation_inputs = {
-                k: v.to(self.accelerator.device)
-                for k, v in self._collate_fn(
+            if lm_inputs is None:
+                lm_inputs = self._collate_fn(
                     [{**inp, "target": t} for inp, t in zip(inputs, targets)]
-                ).items()
+                )
+            generation_inputs = {
+                k: v.to(self.accelerator.device, non_blocking=True)
+                for k, v in lm_inputs.items()
             }
 
-            with torch.inference_mode(mode=not self.args.use_lm_loss):
+            ## NOTE: Keep the graph if the KL term will reuse this forward.
+            keep_graph = self.args.use_lm_loss or (
+                self.args.kl_decay > 0.0 and torch.is_grad_enabled()
+            )
+            with torch.inference_mode(mode=not keep_graph):
                 lm_loss, generation_outputs = model(
                     **generation_inputs, return_outputs=True
                 )
 
+            if not self.args.use_lm_loss:
+                lm_loss = lm_loss.detach()
+
+            lm_outputs = (generation_inputs, generation_outputs)
+
             predictions = self.tokenizer.batch_decode(
                 generation_outputs.logits[:, -1, :].argmax(dim=-1),
                 skip_special_tokens=True,
@@ -108,7 +141,7 @@ class CalibrationTuner(Trainer):
             lm_loss.requires_grad == self.args.use_lm_loss
         ), f"Expected lm_loss to be detached."
 
-        return predictions, lm_loss
+        return predictions, lm_loss, lm_outputs
 
     def compute_query_loss(self, model, inputs, targets, predictions):
         q_labels = (
@@ -145,53 +178,71 @@ class CalibrationTuner(Trainer):
 
         return q_loss
 
-    def compute_kl_loss(self, model, inputs, targets):
+    def compute_kl_loss(self, model, inputs, targets, lm_outputs=None):
         if self.args.kl_decay <= 0.0:
             return torch.tensor(0.0)
 
-        ref_inputs = {
-            k: v.to(self.accelerator.device)
-            for k, v in self._collate_fn(
-                [{**inp, "target": t} for inp, t in zip(inputs, targets)]
-            ).items()
-        }
+        ## NOTE: Same inputs as the LM pass, reuse its forward when available.
+        if lm_outputs is not None:
+            ref_inputs, outputs = lm_outputs
+        else:
+            ref_inputs = {
+                k: v.to(self.accelerator.device)
+                for k, v in self._collate_fn(
+                    [{**inp, "target": t} for inp, t in zip(inputs, targets)]
+                ).items()
+            }
+            outputs = model(**ref_inputs)
 
-        probs = model(**ref_inputs).logits[..., :-1, :].softmax(dim=-1)
+        logits = outputs.logits[..., :-1, :]
 
         with torch.inference_mode():
             ## NOTE: self.model is always unwrapped.
             self.model.set_adapter(self.args.ref_adapter_name)
 
-            ref_probs = self.model(**ref_inputs).logits[..., :-1, :].softmax(dim=-1)
+            ref_logits = self.model(**ref_inputs).logits[..., :-1, :]
 
             self.model.set_adapter("default")
 
         labels = ref_inputs.pop("labels")[..., 1:]
 
-        p = Categorical(probs=probs)
-        p_ref = Categorical(probs=ref_probs)
+        ## NOTE: Stay in log-space, F.kl_div(log_q, log_p) is KL(p || q).
+        if self.args.kl_topk > 0:
+            ## NOTE: Clone to leave inference mode, gather saves the index for backward.
+            topk_idx = ref_logits.topk(self.args.kl_topk, dim=-1).indices.clone()
+            log_p = topk_log_probs(logits, topk_idx)
+            log_p_ref = topk_log_probs(ref_logits, topk_idx)
+        else:
+            log_p = logits.log_softmax(dim=-1)
+            log_p_ref = ref_logits.log_softmax(dim=-1)
+        kl = partial(F.kl_div, reduction="none", log_target=True)
 
         if self.args.kl_type == "reverse_kl":
-            kl_loss = kl_divergence(p, p_ref)
+            kl_loss = kl(log_p_ref, log_p).sum(dim=-1)
         elif self.args.kl_type == "forward_kl":
-            kl_loss = kl_divergence(p_ref, p)
+            kl_loss = kl(log_p, log_p_ref).sum(dim=-1)
         elif self.args.kl_type == "jsd":
-            p_mix = Categorical(probs=(probs + ref_probs) / 2)
-            kl_loss = (kl_divergence(p, p_mix) + kl_divergence(p_ref, p_mix)) / 2
+            log_p_mix = torch.logaddexp(log_p, log_p_ref) - math.log(2)
+            kl_loss = (
+                kl(log_p_mix, log_p).sum(dim=-1) + kl(log_p_mix, log_p_ref).sum(dim=-1)
+            ) / 2
         else:
             raise NotImplementedError
 
-        loss_mask = labels != IGNORE_LABEL
-        loss = (kl_loss * loss_mask).sum(dim=-1).mean(dim=0)
+        ## NOTE: Zero ignored positions in place of a bool-to-float multiply.
+        loss = kl_loss.masked_fill(labels == IGNORE_LABEL, 0.0).sum(dim=-1).mean(dim=0)
 
         return loss
 
     def compute_loss(self, model, inputs, return_outputs=False, return_metrics=False):
         inputs.pop("embedding", None)
+        lm_inputs = inputs.pop("lm_inputs", None)
         inputs = [dict(zip(inputs.keys(), vals)) for vals in zip(*inputs.values())]
         targets = [inp.pop("target") for inp in inputs]
 
-        predictions, lm_loss = self.compute_lm_loss(model, inputs, targets)
+        predictions, lm_loss, lm_outputs = self.compute_lm_loss(
+            model, inputs, targets, lm_inputs=lm_inputs
+        )
 
         q_loss = self.compute_query_loss(
             model,
@@ -200,19 +251,20 @@ class CalibrationTuner(Trainer):
             predictions,
         )
 
-        kl_loss = self.compute_kl_loss(model, inputs, targets)
+        kl_loss = self.compute_kl_loss(model, inputs, targets, lm_outputs=lm_outputs)
 
         loss_metrics = {
-            "lm_loss": lm_loss.detach().item(),
-            "q_loss": q_loss.detach().item(),
-            "kl_loss": kl_loss.detach().item(),
+            "lm_loss": lm_loss.detach(),
+            "q_loss": q_loss.detach(),
+            "kl_loss": kl_loss.detach(),
         }
 
+        ## NOTE: Eval consumes device tensors, .item() syncs only on logging steps.
         if return_metrics:
             return loss_metrics
 
         if (self.state.global_step + 1) % self.args.logging_steps == 0:
-            self.log(loss_metrics)
+            self.log({k: v.item() for k, v in loss_metrics.items()})
 
         loss = lm_loss + q_loss + self.args.kl_decay * kl_loss
 
@@ -234,10 +286,11 @@ class CalibrationTuner(Trainer):
                 )
 
             ## De-mean for distributed computation. Size for correct gather.
+            device = self.accelerator.device
             loss_metrics = {
-                k: torch.zeros(B)
-                .index_fill_(0, torch.tensor([0]).long(), v * B)
-                .to(self.accelerator.device)
+                k: torch.zeros(B, device=device).index_fill_(
+                    0, torch.tensor([0], device=device), v.to(device).float() * B
+                )
                 for k, v in loss_metrics.items()
             }
 
@@ -291,7 +344,7 @@ class CalibrationTuner(Trainer):
         if self.tokenizer is not None:
             self.tokenizer.save_pretrained(output_dir)
 
-        torch.save(self.args, os.path.join(output_dir, TRAINING_ARGS_NAME))
+        save_training_args(self.args, output_dir)
 
         if self.args.scale_temp:
             torch.save(
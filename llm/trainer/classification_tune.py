@@ -6,7 +6,6 @@ import torch.nn.functional as F
 from torch.utils.data import default_collate
 from peft import PeftModel
 from transformers.trainer import (
-    TRAINING_ARGS_NAME,
     logger,
     unwrap_model,
     Trainer,
@@ -17,6 +16,7 @@ from ..datasets import (
     LabeledStringDataCollator,
     prepare_uncertainty_query,
 )
+from .utils import save_training_args
 
 
 class ClassificationTuner(Trainer):
@@ -30,7 +30,11 @@ class ClassificationTuner(Trainer):
         log_on_each_node: bool = field(default=False)
         evaluation_strategy: str = field(default="steps")
         dataloader_num_workers: int = field(default=4)
-        optim: str = field(default="adamw_torch")
+        optim: str = field(default="paged_adamw_8bit")
+        gradient_checkpointing: bool = field(default=True)
+        gradient_checkpointing_kwargs: dict = field(
+            default_factory=lambda: {"use_reentrant": False}
+        )
         lr: float = field(default=1e-4)
         lr_scheduler_type: str = field(default="cosine")
         weight_decay: float = field(default=0.0)
@@ -154,11 +158,12 @@ class ClassificationTuner(Trainer):
 
         loss = F.cross_entropy(class_logits, class_labels)
 
-        loss_metrics = {
-            "loss": loss.detach().item(),
-        }
-
+        ## NOTE: .item() blocks on the device, only sync on logging steps.
         if (self.state.global_step + 1) % self.args.logging_steps == 0:
+            loss_metrics = {
+                "loss": loss.detach().item(),
+            }
+
             self.log(loss_metrics)
 
         return (loss, None) if return_outputs else loss
@@ -226,7 +231,7 @@ class ClassificationTuner(Trainer):
         if self.tokenizer is not None:
             self.tokenizer.save_pretrained(output_dir)
 
-        torch.save(self.args, os.path.join(output_dir, TRAINING_ARGS_NAME))
+        save_training_args(self.args, output_dir)
 
         torch.save(
             unwrap_model(self.classifier_model).state_dict(),
@@ -6,7 +6,6 @@ import torch.nn.functional as F
 from torch.utils.data import default_collate
 from peft import PeftModel
 from transformers.trainer import (
-    TRAINING_ARGS_NAME,
     logger,
     unwrap_model,
     Trainer,
@@ -18,6 +17,7 @@ from ..datasets import (
     LabeledStringDataCollator,
     prepare_uncertainty_query,
 )
+from .utils import save_training_args
 
 
 class EmbeddingTuner(Trainer):
@@ -137,11 +137,12 @@ class EmbeddingTuner(Trainer):
 
         loss = F.cross_entropy(class_logits, class_labels)
 
-        loss_metrics = {
-            "loss": loss.detach().item(),
-        }
-
+        ## NOTE: .item() blocks on the device, only sync on logging steps.
         if (self.state.global_step + 1) % self.args.logging_steps == 0:
+            loss_metrics = {
+                "loss": loss.detach().item(),
+            }
+
             self.log(loss_metrics)
 
         return (loss, None) if return_outputs else loss
@@ -207,7 +208,7 @@ class EmbeddingTuner(Trainer):
         if self.tokenizer is not None:
             self.tokenizer.save_pretrained(output_dir)
 
-        torch.save(self.args, os.path.join(output_dir, TRAINING_ARGS_NAME))
+        save_training_args(self.args, output_dir)
 
         torch.save(
             unwrap_model(self.classifier_model).state_dict(),
@@ -2,16 +2,15 @@ import os
 from dataclasses import dataclass, field
 from tqdm.auto import tqdm
 import torch
-from torch.utils.data import default_collate
 from transformers.trainer import (
     Trainer,
     logger,
     unwrap_model,
-    TRAINING_ARGS_NAME,
     TrainingArguments,
 )
 
 from ..datasets import LabeledStringDataCollator
+from .utils import save_training_args
 
 
 class FineTuner(Trainer):
@@ -25,7 +24,11 @@ class FineTuner(Trainer):
         log_on_each_node: bool = field(default=False)
         evaluation_strategy: str = field(default="steps")
         dataloader_num_workers: int = field(default=4)
-        optim: str = field(default="adamw_torch")
+        optim: str = field(default="paged_adamw_8bit")
+        gradient_checkpointing: bool = field(default=True)
+        gradient_checkpointing_kwargs: dict = field(
+            default_factory=lambda: {"use_reentrant": False}
+        )
         lr: float = field(default=1e-4)
         lr_scheduler_type: str = field(default="cosine")
         weight_decay: float = field(default=0.0)
@@ -38,29 +41,15 @@ class FineTuner(Trainer):
     def __init__(self, args=None, train_dataset=None, tokenizer=None, **kwargs):
         args.label_names = train_dataset.column_names
 
-        self._collate_fn = LabeledStringDataCollator(tokenizer)
-
         super().__init__(
             **kwargs,
             args=args,
             tokenizer=tokenizer,
             train_dataset=train_dataset,
-            data_collator=default_collate,
+            ## NOTE: Rows arrive pre-tokenized, the collator only pads.
+            data_collator=LabeledStringDataCollator(tokenizer),
         )
 
-    def compute_loss(self, model, inputs, **kwargs):
-        inputs = [dict(zip(inputs.keys(), vals)) for vals in zip(*inputs.values())]
-        targets = [inp.pop("target") for inp in inputs]
-
-        loss_inputs = {
-            k: v.to(self.accelerator.device)
-            for k, v in self._collate_fn(
-                [{**inp, "target": t} for inp, t in zip(inputs, targets)]
-            ).items()
-        }
-
-        return super().compute_loss(model, loss_inputs, **kwargs)
-
     def evaluate(self, eval_dataset=None, metric_key_prefix="eval", **_):
         eval_dataset = eval_dataset if eval_dataset is not None else self.eval_dataset
 
@@ -69,16 +58,11 @@ class FineTuner(Trainer):
         all_metrics = {"loss": []}
 
         for inputs in tqdm(eval_dataloader, leave=False):
-            inputs = [dict(zip(inputs.keys(), vals)) for vals in zip(*inputs.values())]
-            targets = [inp.pop("target") for inp in inputs]
-            B = len(inputs)
-
             loss_inputs = {
-                k: v.to(self.accelerator.device)
-                for k, v in self._collate_fn(
-                    [{**inp, "target": t} for inp, t in zip(inputs, targets)]
-                ).items()
+                k: v.to(self.accelerator.device, non_blocking=True)
+                for k, v in inputs.items()
             }
+            B = loss_inputs.get("input_ids").size(0)
 
             with torch.inference_mode():
                 loss = super().compute_loss(
@@ -131,10 +115,18 @@ class FineTuner(Trainer):
         if self.tokenizer is not None:
             self.tokenizer.save_pretrained(output_dir)
 
-        torch.save(self.args, os.path.join(output_dir, TRAINING_ARGS_NAME))
+        save_training_args(self.args, output_dir)
 
         if self.args.scale_temp:
+            ## NOTE: Save only the temperature scalar, detached on CPU.
+            temperature_model = unwrap_model(self.model).lm_head[-1]
             torch.save(
-                unwrap_model(self.model).lm_head[-1].state_dict(),
+                {
+                    "log_temperature": temperature_model.get_parameter(
+                        "log_temperature"
+                    )
+                    .detach()
+                    .cpu()
+                },
                 os.path.join(output_dir, self.TEMPERATURE_WEIGHTS_NAME),
             )
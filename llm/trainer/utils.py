@@ -1,7 +1,17 @@
+import os
 import wandb
 from transformers.trainer import TrainerCallback
 
 
+TRAINING_ARGS_JSON_NAME = "training_args.json"
+
+
+def save_training_args(args, output_dir):
+    ## NOTE: Plain JSON instead of pickling the whole TrainingArguments object.
+    with open(os.path.join(output_dir, TRAINING_ARGS_JSON_NAME), "w") as f:
+        f.write(args.to_json_string())
+
+
 class WandbConfigUpdateCallback(TrainerCallback):
     def __init__(self, **config):
         self._config = config
@@ -1,33 +1,95 @@
-import pandas as pd
+import csv
+import tempfile
 import torch
 import torch.nn.functional as F
 from tqdm.auto import tqdm
 from peft import PeftModel
 
-from llm.datasets import LabeledStringDataCollator
+from llm.datasets import LabeledStringDataCollator, get_num_proc
 
 
-def wrapped_generate_output(model, tokenizer, generation_inputs, generation_config):
-    while True:
-        try:
-            terminators = [
-                tokenizer.eos_token_id,
-                tokenizer.convert_tokens_to_ids("<|eot_id|>")
+## NOTE: Use as loader collate_fn, so tokenization runs in the loader workers.
+class GenerationCollator:
+    def __init__(self, tokenizer):
+        self.collate_fn = LabeledStringDataCollator(tokenizer)
+
+    def __call__(self, instances):
+        inputs = [dict(instance) for instance in instances]
+        targets = [inp.pop("target") for inp in inputs]
+
+        ## NOTE: Pre-tokenized by tokenize_prompts, only pad.
+        if "input_ids" in inputs[0]:
+            features = [
+                {k: inp.pop(k) for k in ["input_ids", "attention_mask"]}
+                for inp in inputs
             ]
-            generation_outputs = model.generate(
-                **generation_inputs, 
-                eos_token_id=terminators,
-                generation_config=generation_config
+            return inputs, targets, self.collate_fn.pad(features)
+
+        return inputs, targets, self.collate_fn(inputs)
+
+
+def tokenize_prompts(data, tokenizer, num_workers=None):
+    collate_fn = LabeledStringDataCollator(tokenizer)
+    tokenizer_args = {
+        **collate_fn.get_tokenizer_args(tokenizer),
+        "padding": False,
+        "pad_to_multiple_of": None,
+        "return_tensors": None,
+        "return_length": True,
+    }
+
+    def _tokenize(samples):
+        instances = [
+            {k: v for k, v in zip(samples.keys(), vals) if k != "target"}
+            for vals in zip(*samples.values())
+        ]
+        return tokenizer(collate_fn.get_prompts(instances), **tokenizer_args)
+
+    ## NOTE: Tokenize once into the Arrow cache, instead of every loader pass.
+    return data.map(_tokenize, batched=True, num_proc=get_num_proc(data, num_workers))
+
+
+def sort_by_prompt_length(data):
+    ## NOTE: Longest first, so padding stays low and OOM surfaces early.
+    return data.sort("length", reverse=True).remove_columns("length")
+
+
+def wrapped_generate_output(model, tokenizer, generation_inputs, generation_config):
+    try:
+        terminators = [
+            tokenizer.eos_token_id,
+            tokenizer.convert_tokens_to_ids("<|eot_id|>")
+        ]
+        generation_outputs = model.generate(
+            **generation_inputs, 
+            eos_token_id=terminators,
+            generation_config=generation_config
+        )
+        return generation_outputs
+    except torch.cuda.OutOfMemoryError:
+        B = generation_inputs["input_ids"].size(0)
+        if B == 1:
+            raise
+
+        torch.cuda.empty_cache()
+
+        generation_outputs = []
+        new_bs = (B + 1) // 2
+        for i in range(0, B, new_bs):
+            inputs = {k: v[i : i + new_bs] for k, v in generation_inputs.items()}
+            _outputs = wrapped_generate_output(
+                model, tokenizer, inputs, generation_config
             )
-            return generation_outputs
-        except Exception as e:
-            generation_outputs = []
-            new_bs = max(1, generation_inputs["input_ids"].size(0) // 2)
-            for i in range(0, generation_inputs["input_ids"].size(0), new_bs):
-                inputs = {k: v[i : i + new_bs] for k, v in generation_inputs.items()}
-                _outputs = wrapped_generate_output(model, inputs, generation_config)
-                generation_outputs.append(_outputs)
-            return torch.cat(generation_outputs, dim=0)
+            generation_outputs.append(_outputs)
+
+        ## NOTE: Sub-batches may stop at different lengths.
+        max_len = max(o.size(-1) for o in generation_outputs)
+        generation_outputs = [
+            F.pad(o, (0, max_len - o.size(-1)), value=tokenizer.pad_token_id)
+            for o in generation_outputs
+        ]
+        return torch.cat(generation_outputs, dim=0)
+
 
 def generate_output(
     accelerator,
@@ -39,33 +101,52 @@ def generate_output(
     n_samples=0,
     log_dir=None,
 ):
-    collate_fn = LabeledStringDataCollator(tokenizer)
+    rows = _generate_output_rows(
+        accelerator,
+        model,
+        tokenizer,
+        loader,
+        generation_config=generation_config,
+        generation_config_sampling=generation_config_sampling,
+        n_samples=n_samples,
+    )
 
-    all_outputs = []
+    save_output_rows(accelerator, rows, log_dir=log_dir)
 
-    for inputs in tqdm(loader):
-        inputs = [dict(zip(inputs.keys(), vals)) for vals in zip(*inputs.values())]
-        targets = [inp.pop("target") for inp in inputs]
 
+@torch.inference_mode()
+def _generate_output_rows(
+    accelerator,
+    model,
+    tokenizer,
+    loader,
+    generation_config=None,
+    generation_config_sampling=None,
+    n_samples=0,
+):
+    if isinstance(model, PeftModel):
+        model.set_adapter("default")
+
+    for inputs, targets, generation_inputs in tqdm(
+        loader, disable=not accelerator.is_main_process
+    ):
         generation_inputs = {
-            k: v.to(accelerator.device) for k, v in collate_fn(inputs).items()
+            k: v.to(accelerator.device, non_blocking=True)
+            for k, v in generation_inputs.items()
         }
 
-        if isinstance(model, PeftModel):
-            model.set_adapter("default")
-        
+        ## NOTE: Left-padded prompts, so new tokens start at the same offset.
+        input_len = generation_inputs.get("input_ids").size(-1)
+
         generation_outputs = wrapped_generate_output(
             model, tokenizer, generation_inputs, generation_config
         )
 
         generations = tokenizer.batch_decode(
-            generation_outputs[:, generation_inputs.get("input_ids").size(-1) :],
+            generation_outputs[:, input_len:],
             skip_special_tokens=True,
             clean_up_tokenization_spaces=False,
         )
-        
-        # for x in generations:
-        #     print(x)
 
         outputs = [
             {**inp, "target": tgt, "output": gen}
@@ -90,9 +171,9 @@ def generate_output(
                 {
                     **o,
                     "sampled_outputs": tokenizer.batch_decode(
-                        so["sequences"][
-                            :, generation_inputs.get("input_ids").size(-1) :
-                        ]
+                        so["sequences"][:, input_len:],
+                        skip_special_tokens=True,
+                        clean_up_tokenization_spaces=False,
                     ),
                     "sampled_log_probs": F.log_softmax(
                         torch.cat(so["scores"], dim=0), dim=-1
@@ -101,11 +182,107 @@ def generate_output(
                 for o, so in zip(outputs, sampled_outputs)
             ]
 
-        all_outputs.extend(outputs)
+        yield from outputs
+
+
+def write_csv_rows(rows, path, flush_every=1000):
+    ## NOTE: Stream rows to disk, header taken from the first row.
+    with open(path, "w", newline="") as f:
+        writer = None
+        for i, row in enumerate(rows, start=1):
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=list(row.keys()))
+                writer.writeheader()
+            writer.writerow(row)
+
+            if i % flush_every == 0:
+                f.flush()
+
+
+def save_output_rows(accelerator, rows, log_dir=None):
+    ## NOTE: Avoid spec errors when loading for labeling.
+    rows = ({**row, "query_label": -1} for row in rows)
+
+    if log_dir is None:
+        for _ in rows:
+            pass
+        return
+
+    write_csv_rows(rows, f"{log_dir}/rows_{accelerator.process_index}.csv")
+
+
+def get_vllm_model(model, tokenizer, max_model_len=None, **kwargs):
+    from vllm import LLM
+
+    if isinstance(model, PeftModel):
+        model = model.merge_and_unload()
+
+    ## NOTE: vLLM loads from disk, including the resized embeddings for the pad token.
+    ## Weights are in memory once LLM returns, so the merged copy is removed.
+    with tempfile.TemporaryDirectory() as model_dir:
+        model.save_pretrained(model_dir)
+        tokenizer.save_pretrained(model_dir)
+
+        return LLM(
+            model=model_dir,
+            tokenizer=model_dir,
+            dtype=model.dtype,
+            max_model_len=max_model_len,
+            **kwargs,
+        )
+
+
+def generate_output_vllm(
+    accelerator,
+    llm,
+    tokenizer,
+    loader,
+    generation_config=None,
+    log_dir=None,
+):
+    from vllm import SamplingParams
+
+    assert (
+        accelerator.num_processes == 1
+    ), "vLLM handles parallelism, launch a single process."
+
+    sampling_params = SamplingParams(
+        temperature=0.0,
+        max_tokens=generation_config.max_new_tokens,
+        stop_token_ids=[
+            tokenizer.eos_token_id,
+            tokenizer.convert_tokens_to_ids("<|eot_id|>"),
+        ],
+        skip_special_tokens=True,
+    )
+
+    all_inputs, all_targets, all_prompt_token_ids = [], [], []
+
+    for inputs, targets, generation_inputs in tqdm(
+        loader, disable=not accelerator.is_main_process
+    ):
+        ## NOTE: Strip padding, vLLM schedules variable-length prompts itself.
+        prompt_token_ids = [
+            ids[mask.bool()].tolist()
+            for ids, mask in zip(
+                generation_inputs.get("input_ids"),
+                generation_inputs.get("attention_mask"),
+            )
+        ]
+
+        all_inputs.extend(inputs)
+        all_targets.extend(targets)
+        all_prompt_token_ids.extend(prompt_token_ids)
+
+    ## NOTE: Submit all prompts at once to use continuous batching.
+    generation_outputs = llm.generate(
+        [{"prompt_token_ids": ids} for ids in all_prompt_token_ids],
+        sampling_params=sampling_params,
+    )
 
-    if log_dir is not None:
-        df = pd.DataFrame(all_outputs)
-        ## NOTE: Avoid spec errors when loading for labeling.
-        df["query_label"] = -1
+    rows = (
+        {**inp, "target": tgt, "output": out.outputs[0].text}
+        for inp, tgt, out in zip(all_inputs, all_targets, generation_outputs)
+    )
 
-        df.to_csv(f"{log_dir}/rows_{accelerator.process_index}.csv", index=False)
+    save_output_rows(accelerator, rows, log_dir=log_dir)
@@ -0,0 +1,29 @@
+import pytest
+
+pytest.importorskip("torch")
+datasets = pytest.importorskip("datasets")
+
+from llm.datasets import register_dataset
+from llm.datasets.offline.combined import get_combined_dataset
+
+
+_seen_num_workers = []
+
+
+@register_dataset(attrs=dict(unlisted=True))
+def _test_combined_component(*args, num_workers=8, **kwargs):
+    _seen_num_workers.append(num_workers)
+
+    data = datasets.Dataset.from_dict({"context": ["a", "b"], "target": ["x", "y"]})
+    return data, data, data
+
+
+def test_combined_components_load_in_process(tmp_path, monkeypatch):
+    monkeypatch.setenv("PROJECT_HOME", str(tmp_path))
+
+    tr, vl, te = get_combined_dataset(
+        ["_test_combined_component"] * 2, max_n=4, seed=0, num_workers=8
+    )
+
+    assert _seen_num_workers == [1, 1]
+    assert len(tr) == len(vl) == len(te) == 4
@@ -0,0 +1,65 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("datasets")
+transformers = pytest.importorskip("transformers")
+tokenizers = pytest.importorskip("tokenizers")
+
+from llm.datasets import IGNORE_LABEL, LabeledStringDataCollator
+from llm.datasets.llm_data_utils import LLAMA_3_SYS_PROMPT
+
+
+## NOTE: Same layout as the Llama-3-Instruct template.
+CHAT_TEMPLATE = (
+    "{% for m in messages %}<|start_header_id|>{{ m['role'] }}<|end_header_id|>\n\n"
+    "{{ m['content'] | trim }}<|eot_id|>{% endfor %}"
+    "{% if add_generation_prompt %}<|start_header_id|>assistant<|end_header_id|>\n\n"
+    "{% endif %}"
+)
+
+SPECIAL_TOKENS = [
+    "[PAD]",
+    "[UNK]",
+    "<|start_header_id|>",
+    "<|end_header_id|>",
+    "<|eot_id|>",
+]
+
+
+def get_chat_tokenizer(texts):
+    pre_tokenizer = tokenizers.pre_tokenizers.Whitespace()
+    words = sorted({w for t in texts for w, _ in pre_tokenizer.pre_tokenize_str(t)})
+    vocab = {w: i for i, w in enumerate(SPECIAL_TOKENS + words)}
+
+    backend = tokenizers.Tokenizer(
+        tokenizers.models.WordLevel(vocab=vocab, unk_token="[UNK]")
+    )
+    backend.pre_tokenizer = pre_tokenizer
+    backend.add_special_tokens(SPECIAL_TOKENS)
+
+    tokenizer = transformers.PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        name_or_path="meta-llama/Meta-Llama-3-8B-Instruct",
+        pad_token="[PAD]",
+        unk_token="[UNK]",
+    )
+    tokenizer.chat_template = CHAT_TEMPLATE
+
+    return tokenizer
+
+
+def test_labels_cover_only_the_target_with_chat_template():
+    ## NOTE: Short targets also occur in the template text after the prompt.
+    instances = [
+        {"context": "Is water wet?", "target_prompt": "\nAnswer:", "target": "a"},
+        {"context": "Pick one.", "target_prompt": "\nAnswer:", "target": "yes"},
+    ]
+
+    tokenizer = get_chat_tokenizer(
+        [LLAMA_3_SYS_PROMPT, "system user assistant"]
+        + [v for instance in instances for v in instance.values()]
+    )
+    inputs = LabeledStringDataCollator(tokenizer)(instances)
+
+    for labels, instance in zip(inputs.get("labels"), instances):
+        assert tokenizer.decode(labels[labels != IGNORE_LABEL]) == instance["target"]